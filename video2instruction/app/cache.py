@@ -0,0 +1,123 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from django.conf import settings
+
+_lock = threading.Lock()
+_local = threading.local()
+_schema_ready = set()
+_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def _create_schema(connection):
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS responses ("
+        "key TEXT PRIMARY KEY, "
+        "model TEXT NOT NULL, "
+        "response TEXT NOT NULL, "
+        "created_at REAL NOT NULL, "
+        "last_used REAL NOT NULL)"
+    )
+    connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+    connection.commit()
+
+
+def _connection():
+    # One connection per thread and cache file, SQLite in WAL mode lets them read concurrently
+    path = str(settings.LLM_CACHE_PATH)
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    connection = connections.get(path)
+    if connection is None:
+        connection = connections[path] = sqlite3.connect(path, timeout=30)
+        with _lock:
+            if path not in _schema_ready:
+                _create_schema(connection)
+                _schema_ready.add(path)
+    return connection
+
+
+def cache_key(model, prompt, images=None, **options):
+    digest = hashlib.sha256()
+    digest.update(model.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(prompt.encode("utf-8"))
+    for image in images or []:
+        digest.update(b"\0")
+        digest.update(hashlib.sha256(_image_bytes(image)).digest())
+    if options:
+        digest.update(b"\0")
+        digest.update(json.dumps(options, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _image_bytes(image):
+    return image if isinstance(image, bytes) else image.encode("ascii")
+
+
+def get(key):
+    if not settings.LLM_CACHE_ENABLED:
+        return None
+
+    connection = _connection()
+    row = connection.execute("SELECT response, last_used FROM responses WHERE key = ?", (key,)).fetchone()
+    with _lock:
+        _stats["hits" if row else "misses"] += 1
+    if row is None:
+        return None
+
+    # Eviction only needs a rough order, so a hit writes last_used at most once per interval
+    now = time.time()
+    if now - row[1] > settings.LLM_CACHE_TOUCH_INTERVAL:
+        with connection:
+            connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+    return row[0]
+
+
+def put(key, model, response):
+    if not settings.LLM_CACHE_ENABLED:
+        return
+
+    now = time.time()
+    connection = _connection()
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO responses (key, model, response, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+            (key, model, response, now, now)
+        )
+
+        count = connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        overflow = count - settings.LLM_CACHE_MAX_ENTRIES
+        if overflow > 0:
+            connection.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY last_used ASC LIMIT ?)",
+                (overflow,)
+            )
+
+    if overflow > 0:
+        with _lock:
+            _stats["evictions"] += overflow
+
+
+def delete(key):
+    if not settings.LLM_CACHE_ENABLED:
+        return
+
+    connection = _connection()
+    with connection:
+        connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+
+def stats():
+    with _lock:
+        result = dict(_stats)
+    lookups = result["hits"] + result["misses"]
+    result["hit_rate"] = result["hits"] / lookups if lookups else 0.0
+    return result
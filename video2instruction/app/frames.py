@@ -0,0 +1,122 @@
+import base64
+import threading
+
+from collections import OrderedDict
+
+import cv2
+
+from django.conf import settings
+
+from .metrics import timer
+
+
+class FrameStore:
+    def __init__(self, max_frames):
+        self.max_frames = max_frames
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, key, encoded):
+        image_base64 = base64.b64encode(encoded).decode("utf-8")
+        with self._lock:
+            self._frames[key] = image_base64
+            self._frames.move_to_end(key)
+            while len(self._frames) > self.max_frames:
+                self._frames.popitem(last=False)
+        return image_base64
+
+    def get(self, key):
+        with self._lock:
+            image_base64 = self._frames.get(key)
+            if image_base64 is not None:
+                self._frames.move_to_end(key)
+            return image_base64
+
+    def discard_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._frames if k.startswith(prefix)]:
+                del self._frames[key]
+
+
+frame_store = FrameStore(settings.FRAME_STORE_MAX_FRAMES)
+
+_stats_lock = threading.Lock()
+_stats = {"frames": 0, "model_bytes": 0, "baseline_samples": 0, "baseline_sample_bytes": 0}
+PREPROCESS_STAT_KEYS = tuple(_stats)
+
+
+def record_preprocess_stats(delta):
+    with _stats_lock:
+        for key, value in delta.items():
+            _stats[key] += value
+
+
+def estimate_baseline_bytes(frames, samples, sample_bytes):
+    return round(sample_bytes * frames / samples) if samples else 0
+
+
+def preprocess_stats():
+    with _stats_lock:
+        result = dict(_stats)
+    result["baseline_bytes"] = estimate_baseline_bytes(
+        result["frames"], result["baseline_samples"], result["baseline_sample_bytes"]
+    )
+    result["bytes_saved"] = result["baseline_bytes"] - result["model_bytes"]
+    return result
+
+
+def _baseline_sample(frame):
+    # The saving is measured against what was sent before preprocessing, a full-resolution JPEG.
+    # Encoding one costs more than the model frame itself, so only a sample of frames pays for it.
+    with _stats_lock:
+        sampled = _stats["frames"] % settings.PREPROCESS_BASELINE_SAMPLE_EVERY == 0
+    if not sampled:
+        return {}
+    _, baseline = cv2.imencode(".jpg", frame)
+    return {"baseline_samples": 1, "baseline_sample_bytes": baseline.size}
+
+
+def preprocess_frame(frame):
+    crop = settings.MODEL_FRAME_CROP
+    if crop:
+        height, width = frame.shape[:2]
+        x, y, w, h = crop
+        frame = frame[int(y * height):int((y + h) * height), int(x * width):int((x + w) * width)]
+
+    if settings.MODEL_FRAME_GRAYSCALE:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    height, width = frame.shape[:2]
+    scale = settings.MODEL_FRAME_MAX_SIDE / max(height, width)
+    if scale < 1:
+        frame = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+
+    return frame
+
+
+def encode_frame(frame):
+    with timer("encode"):
+        processed = preprocess_frame(frame)
+        _, encoded = cv2.imencode(".jpg", processed, [cv2.IMWRITE_JPEG_QUALITY, settings.MODEL_FRAME_JPEG_QUALITY])
+
+        record_preprocess_stats({**_baseline_sample(frame), "frames": 1, "model_bytes": encoded.size})
+
+        # Thumbnails are shown to the user, so they keep the full uncropped color frame
+        height, width = frame.shape[:2]
+        scale = settings.FRAME_THUMBNAIL_MAX_SIDE / max(height, width)
+        small = frame
+        if scale < 1:
+            small = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        _, thumbnail = cv2.imencode(".jpg", small, [cv2.IMWRITE_JPEG_QUALITY, settings.FRAME_THUMBNAIL_QUALITY])
+
+    return encoded, thumbnail
+
+
+def load_image_base64(path):
+    image_base64 = frame_store.get(path)
+    if image_base64 is not None:
+        return image_base64
+
+    # Another process extracted the frame, fall back to the thumbnail persisted on disk
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode("utf-8")
@@ -0,0 +1,237 @@
+import json
+import time
+import asyncio
+import logging
+import threading
+
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from .llm import get_client
+from .metrics import inc, job_id_var, timer, timed_iter
+from .models import Job, Video, Frame
+from .workspace import frames_dir
+from .utils import (
+    iter_video_frames, iter_dedup_frames, estimate_frame_count, prefetch, describe_images, describe_images_parallel
+)
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=settings.JOB_WORKERS, thread_name_prefix="job-worker")
+_recovered = False
+_recover_lock = threading.Lock()
+_running = set()
+_running_lock = threading.Lock()
+
+
+def recover_jobs():
+    # A running job touches its row at least every heartbeat, one that stopped updating belongs
+    # to a process that died and starts over. Queued jobs of that process are picked up here too.
+    cutoff = timezone.now() - timedelta(seconds=settings.JOB_STALE_TIMEOUT)
+    with _running_lock:
+        local = list(_running)
+    requeued = 0
+    for job in Job.objects.filter(status=Job.RUNNING, updated_at__lt=cutoff).exclude(pk__in=local):
+        with transaction.atomic():
+            if Job.objects.filter(pk=job.pk, status=Job.RUNNING, updated_at__lt=cutoff).update(
+                status=Job.QUEUED, progress=0.0, updated_at=timezone.now()
+            ):
+                Frame.objects.filter(job=job).delete()
+                requeued += 1
+
+    if requeued:
+        logger.warning(f"Requeued {requeued} describe jobs left running by a stopped worker")
+    if Job.objects.filter(status=Job.QUEUED).exists():
+        _executor.submit(_drain_queue)
+    return requeued
+
+
+def ensure_jobs_recovered():
+    global _recovered
+    with _recover_lock:
+        if _recovered:
+            return
+        _recovered = True
+    recover_jobs()
+
+
+def enqueue_describe_job(video_path, context, workspace_id):
+    ensure_jobs_recovered()
+    job = Job.objects.create(
+        workspace_id=workspace_id,
+        video=Video.objects.filter(path=video_path).first(),
+        video_path=video_path,
+        context=context or ""
+    )
+    logger.info("Describe job queued", extra={"job_id": str(job.pk), "workspace_id": workspace_id})
+    _executor.submit(_drain_queue)
+    return job
+
+
+def _claim_next_job():
+    while True:
+        job = Job.objects.filter(status=Job.QUEUED).order_by("created_at").first()
+        if job is None:
+            return None
+
+        claimed = Job.objects.filter(pk=job.pk, status=Job.QUEUED).update(status=Job.RUNNING)
+        if claimed:
+            job.status = Job.RUNNING
+            return job
+
+
+def _drain_queue():
+    close_old_connections()
+    try:
+        while True:
+            job = _claim_next_job()
+            if job is None:
+                break
+            _run_describe_job(job)
+    finally:
+        close_old_connections()
+
+
+def _heartbeat(job_id, stopped):
+    try:
+        while not stopped.wait(settings.JOB_HEARTBEAT_INTERVAL):
+            Job.objects.filter(pk=job_id, status=Job.RUNNING).update(updated_at=timezone.now())
+    finally:
+        connection.close()
+
+
+def _run_describe_job(job):
+    token = job_id_var.set(str(job.pk))
+    with _running_lock:
+        _running.add(job.pk)
+    stopped = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job.pk, stopped), name=f"job-heartbeat-{job.pk}", daemon=True).start()
+    try:
+        with timer("job"):
+            _describe_job(job)
+    finally:
+        stopped.set()
+        with _running_lock:
+            _running.discard(job.pk)
+        inc("v2i_jobs_total", status=job.status)
+        job_id_var.reset(token)
+
+
+def _describe_job(job):
+    def update_progress(fraction):
+        job.progress = fraction
+        job.save(update_fields=["progress", "updated_at"])
+
+    def on_description(index, item):
+        # Each description is stored as it arrives, so streamed results survive a failed job
+        job.record_description(index, item)
+
+    try:
+        describe = describe_images_parallel if settings.DESCRIBE_MODE == "parallel" else describe_images
+
+        # Load the model while the video is decoded so the first description doesn't pay for it
+        threading.Thread(target=get_client().warm_up, args=(settings.LLM_MODEL,), daemon=True).start()
+
+        logger.info("Describe job started", extra={"video_path": job.video_path})
+        # Frames are described as soon as they are decoded instead of after the whole video
+        frames = iter_video_frames(job.video_path, frame_dir=frames_dir(job.workspace_id, job.pk))
+        if settings.FRAME_DEDUP:
+            frames = timed_iter(iter_dedup_frames(frames), "dedup")
+        frames = prefetch(frames, settings.PIPELINE_QUEUE_SIZE)
+
+        with timer("describe"):
+            descriptions = describe(
+                frames, job.context,
+                update_progress=update_progress,
+                on_description=on_description,
+                total=estimate_frame_count(job.video_path)
+            )
+
+        job.status = Job.DONE
+        job.progress = 1.0
+        job.save(update_fields=["status", "progress", "updated_at"])
+        logger.info("Describe job finished", extra={"frames": len(descriptions)})
+
+    except Exception as e:
+        logger.exception(f"Job {job.pk} failed: {e}")
+        job.status = Job.FAILED
+        job.error = str(e)
+        job.save(update_fields=["status", "error", "updated_at"])
+
+
+def _sse(event, data, event_id=None):
+    prefix = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{prefix}event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _job_events(job, descriptions, sent):
+    if job is None:
+        return [_sse("failed", {"error": "Job not found"})], sent, True
+
+    events = []
+    for item in descriptions:
+        sent = item["index"] + 1
+        events.append(_sse("description", item, sent))
+
+    if job.status == Job.DONE:
+        events.append(_sse("done", {"total": sent}))
+        return events, sent, True
+
+    if job.status == Job.FAILED:
+        events.append(_sse("failed", {"error": job.error}))
+        return events, sent, True
+
+    events.append(_sse("progress", {"status": job.status, "progress": job.progress}))
+    return events, sent, False
+
+
+def _stall_watch():
+    last = {"state": None, "changed": time.monotonic()}
+
+    def stalled(job, sent):
+        state = (job.status, job.progress, sent)
+        now = time.monotonic()
+        if state != last["state"]:
+            last.update(state=state, changed=now)
+        return now - last["changed"] > settings.JOB_STREAM_STALL_TIMEOUT
+
+    return stalled
+
+
+def poll_job_events(job_id, sent=0):
+    # WSGI servers would hold a worker thread for every open stream, so each request only
+    # answers with what is new and the browser reconnects after the retry delay, sending the
+    # id of the last description it got as Last-Event-ID
+    job = Job.objects.filter(pk=job_id).first()
+    if job and job.status == Job.RUNNING and job.updated_at < timezone.now() - timedelta(seconds=settings.JOB_STALE_TIMEOUT):
+        recover_jobs()
+        job.refresh_from_db()
+
+    descriptions = job.descriptions(start=sent) if job else []
+    events, sent, finished = _job_events(job, descriptions, sent)
+    if not finished:
+        events.append(f"retry: {settings.JOB_POLL_RETRY_MS}\n\n")
+    return events
+
+
+async def astream_job_events(job_id, sent=0):
+    # Waiting between polls doesn't hold a thread, so ASGI servers can keep many streams open
+    stalled = _stall_watch()
+    while True:
+        job = await Job.objects.filter(pk=job_id).afirst()
+        descriptions = await sync_to_async(job.descriptions)(start=sent) if job else []
+        events, sent, finished = _job_events(job, descriptions, sent)
+        for event in events:
+            yield event
+        if finished:
+            return
+        if stalled(job, sent):
+            await sync_to_async(recover_jobs)()
+            yield _sse("stalled", {"status": job.status})
+            return
+        await asyncio.sleep(settings.JOB_STREAM_POLL_INTERVAL)
@@ -0,0 +1,333 @@
+import json
+import time
+import asyncio
+import logging
+import hashlib
+import threading
+import weakref
+import itertools
+
+from ollama import Client, AsyncClient
+from django.conf import settings
+
+from . import cache as llm_cache
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_timings = {"calls": 0, "prompt_tokens": 0, "eval_tokens": 0, "load_ms": 0.0, "prefill_ms": 0.0, "eval_ms": 0.0}
+_client = None
+
+
+def call_timings(response):
+    def ms(field):
+        return (response.get(field) or 0) / 1e6
+
+    return {
+        "prompt_tokens": response.get("prompt_eval_count") or 0,
+        "eval_tokens": response.get("eval_count") or 0,
+        "load_ms": ms("load_duration"),
+        "prefill_ms": ms("prompt_eval_duration"),
+        "eval_ms": ms("eval_duration"),
+    }
+
+
+def record_timings(response, label):
+    timings = call_timings(response)
+    with _lock:
+        _timings["calls"] += 1
+        for key, value in timings.items():
+            _timings[key] += value
+
+    logger.info(
+        f"{label}: prefill {timings['prefill_ms']:.0f} ms ({timings['prompt_tokens']} tokens), "
+        f"eval {timings['eval_ms']:.0f} ms ({timings['eval_tokens']} tokens), load {timings['load_ms']:.0f} ms",
+        extra={"operation": label, **timings}
+    )
+    return timings
+
+
+def timing_stats():
+    with _lock:
+        return dict(_timings)
+
+
+class OllamaBackend:
+    def __init__(self, host=None, keep_alive=None):
+        self.host = host
+        self.keep_alive = keep_alive
+        self.client = Client(host=host)
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def generate(self, model, prompt, images=None, **kwargs):
+        return self.client.generate(model=model, prompt=prompt, images=images, keep_alive=self.keep_alive, **kwargs)
+
+    def chat(self, model, messages, **kwargs):
+        return self.client.chat(model=model, messages=messages, keep_alive=self.keep_alive, **kwargs)
+
+    async def agenerate(self, model, prompt, images=None, **kwargs):
+        # httpx async connections are bound to the event loop, so keep one client per loop
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._async_clients[loop] = AsyncClient(host=self.host)
+        return await client.generate(model=model, prompt=prompt, images=images, keep_alive=self.keep_alive, **kwargs)
+
+    def warm_up(self, model):
+        self.client.generate(model=model, keep_alive=self.keep_alive)
+
+
+class OpenAIBackend:
+    def __init__(self, base_url=None, api_key=None):
+        from openai import OpenAI
+
+        self.base_url = base_url
+        self.api_key = api_key
+        self.client = OpenAI(base_url=base_url, api_key=api_key)
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def _async_client(self):
+        from openai import AsyncOpenAI
+
+        # Like the Ollama backend, one client per event loop since connections are bound to it
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._async_clients[loop] = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key)
+        return client
+
+    def _messages(self, prompt, images):
+        content = [{"type": "text", "text": prompt}]
+        for image in images or []:
+            content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image}"}})
+        return [{"role": "user", "content": content}]
+
+    def _chat_messages(self, messages):
+        converted = []
+        for message in messages:
+            if message.get("images"):
+                converted.extend(self._messages(message["content"], message["images"]))
+            else:
+                converted.append({"role": message["role"], "content": message["content"]})
+        return converted
+
+    def _options(self, format=None, **kwargs):
+        if isinstance(format, dict):
+            return {"response_format": {"type": "json_schema", "json_schema": {"name": "response", "schema": format}}}
+        if format == "json":
+            return {"response_format": {"type": "json_object"}}
+        return {}
+
+    def _usage(self, completion):
+        usage = completion.usage
+        return {
+            "prompt_eval_count": usage.prompt_tokens if usage else 0,
+            "eval_count": usage.completion_tokens if usage else 0,
+        }
+
+    def generate(self, model, prompt, images=None, **kwargs):
+        completion = self.client.chat.completions.create(
+            model=model, messages=self._messages(prompt, images), **self._options(**kwargs)
+        )
+        return {"response": completion.choices[0].message.content or "", **self._usage(completion)}
+
+    def chat(self, model, messages, **kwargs):
+        completion = self.client.chat.completions.create(
+            model=model, messages=self._chat_messages(messages), **self._options(**kwargs)
+        )
+        return {"message": {"content": completion.choices[0].message.content or ""}, **self._usage(completion)}
+
+    async def agenerate(self, model, prompt, images=None, **kwargs):
+        completion = await self._async_client().chat.completions.create(
+            model=model, messages=self._messages(prompt, images), **self._options(**kwargs)
+        )
+        return {"response": completion.choices[0].message.content or "", **self._usage(completion)}
+
+    def warm_up(self, model):
+        pass
+
+
+class FakeBackend:
+    # Deterministic offline backend for load tests and benchmarks: the same prompt always
+    # produces the same answer after a configurable delay, JSON prompts get valid instruction sets.
+    def __init__(self, latency=0.0, image_latency=0.0):
+        self.latency = latency
+        self.image_latency = image_latency
+
+    def _delay(self, images):
+        return self.latency + self.image_latency * len(images or [])
+
+    def _respond(self, prompt, images=None, format=None, **kwargs):
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8]
+        if format or "JSON" in prompt:
+            steps = [line for line in prompt.splitlines() if line.startswith("- ")]
+            text = json.dumps({"instructions": [f"Do step {i + 1} ({digest})." for i in range(len(steps))]})
+        else:
+            text = f"The person performs action {digest}."
+
+        return {
+            "response": text,
+            "prompt_eval_count": len(prompt) // 4 + 576 * len(images or []),
+            "eval_count": len(text) // 4,
+            "prompt_eval_duration": int(self._delay(images) * 0.8e9),
+            "eval_duration": int(self._delay(images) * 0.2e9),
+        }
+
+    def generate(self, model, prompt, images=None, **kwargs):
+        time.sleep(self._delay(images))
+        return self._respond(prompt, images, **kwargs)
+
+    def chat(self, model, messages, **kwargs):
+        images = messages[-1].get("images")
+        time.sleep(self._delay(images))
+        response = self._respond(json.dumps([m["content"] for m in messages]), images, **kwargs)
+        return {**response, "message": {"content": response["response"]}}
+
+    async def agenerate(self, model, prompt, images=None, **kwargs):
+        await asyncio.sleep(self._delay(images))
+        return self._respond(prompt, images, **kwargs)
+
+    def warm_up(self, model):
+        pass
+
+
+class ModelRouter:
+    def __init__(self, backends, strategy="round_robin"):
+        self.backends = backends
+        self.strategy = strategy
+        self.in_flight = [0] * len(backends)
+        self._cycle = itertools.cycle(range(len(backends)))
+        self._lock = threading.Lock()
+
+    def _acquire(self, index=None):
+        with self._lock:
+            if index is None:
+                if self.strategy == "least_loaded":
+                    index = min(range(len(self.backends)), key=lambda i: self.in_flight[i])
+                else:
+                    index = next(self._cycle)
+            self.in_flight[index] += 1
+        return index
+
+    def _release(self, index):
+        with self._lock:
+            self.in_flight[index] -= 1
+
+    def pick(self):
+        with self._lock:
+            return min(range(len(self.backends)), key=lambda i: self.in_flight[i])
+
+    def _finish(self, index, label, started, response=None, error=None):
+        self._release(index)
+        operation = label.split(" #")[0]
+        metrics.observe("v2i_model_call_seconds", time.perf_counter() - started, operation=operation, backend=index)
+        metrics.inc("v2i_model_calls_total", operation=operation, outcome="error" if error else "ok")
+        if error:
+            logger.warning(f"{label} failed on backend {index}: {error}", extra={"operation": operation, "backend": index})
+        else:
+            record_timings(response, label)
+
+    def generate(self, model, prompt, images=None, label="generate", backend=None, **kwargs):
+        index = self._acquire(backend)
+        started = time.perf_counter()
+        try:
+            response = self.backends[index].generate(model, prompt, images=images, **kwargs)
+        except Exception as e:
+            self._finish(index, label, started, error=e)
+            raise
+        self._finish(index, label, started, response)
+        return response
+
+    def chat(self, model, messages, label="chat", backend=None, **kwargs):
+        index = self._acquire(backend)
+        started = time.perf_counter()
+        try:
+            response = self.backends[index].chat(model, messages, **kwargs)
+        except Exception as e:
+            self._finish(index, label, started, error=e)
+            raise
+        self._finish(index, label, started, response)
+        return response
+
+    async def agenerate(self, model, prompt, images=None, label="generate", **kwargs):
+        index = self._acquire()
+        started = time.perf_counter()
+        try:
+            response = await self.backends[index].agenerate(model, prompt, images=images, **kwargs)
+        except Exception as e:
+            self._finish(index, label, started, error=e)
+            raise
+        self._finish(index, label, started, response)
+        return response
+
+    def warm_up(self, model):
+        for backend in self.backends:
+            try:
+                backend.warm_up(model)
+            except Exception as e:
+                logger.warning(f"Could not warm up {model}: {e}")
+
+
+def create_backend(kind, endpoint=None):
+    if kind == "ollama":
+        return OllamaBackend(endpoint, settings.OLLAMA_KEEP_ALIVE)
+    if kind == "openai":
+        return OpenAIBackend(endpoint, settings.OPENAI_API_KEY)
+    if kind == "fake":
+        return FakeBackend(settings.FAKE_LLM_LATENCY, settings.FAKE_LLM_IMAGE_LATENCY)
+    raise ValueError(f"Unknown LLM backend: {kind}")
+
+
+def get_client():
+    global _client
+    with _lock:
+        if _client is None:
+            endpoints = settings.LLM_ENDPOINTS or [None]
+            backends = [create_backend(settings.LLM_BACKEND, endpoint) for endpoint in endpoints]
+            _client = ModelRouter(backends, settings.LLM_ROUTING)
+        return _client
+
+
+def reset_client():
+    global _client
+    with _lock:
+        _client = None
+
+
+class ChatSession:
+    # Keeps the conversation so every turn shares the previous turns as an unchanged prefix,
+    # which Ollama serves from the KV cache of the loaded model instead of re-processing it.
+    # The session stays on one endpoint, since that cache only lives on the host that built it.
+    # Earlier turns are kept as text only and capped at max_turns, so a call carries one image.
+    def __init__(self, model, system=None, client=None, max_turns=None):
+        self.model = model
+        self.client = client or get_client()
+        self.backend = self.client.pick()
+        self.system = [{"role": "system", "content": system}] if system else []
+        self.messages = list(self.system)
+        self.max_turns = max_turns
+
+    def _trim(self):
+        turns = (len(self.messages) - len(self.system)) // 2
+        if self.max_turns and turns > self.max_turns:
+            # Dropping half the turns at once keeps the prefix stable until the next trim
+            keep = max(1, self.max_turns // 2)
+            self.messages = self.system + self.messages[-2 * keep:]
+
+    def send(self, content, images=None, label="chat"):
+        message = {"role": "user", "content": content}
+        if images:
+            message["images"] = images
+        messages = self.messages + [message]
+
+        key = llm_cache.cache_key(self.model, json.dumps(self.messages + [{"role": "user", "content": content}]), images)
+        text = llm_cache.get(key)
+        if text is None:
+            response = self.client.chat(self.model, messages, label=label, backend=self.backend)
+            text = response["message"]["content"]
+            llm_cache.put(key, self.model, text)
+
+        self.messages.extend([{"role": "user", "content": content}, {"role": "assistant", "content": text}])
+        self._trim()
+        return text
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from app import llm
+from app.utils import (
+    handle_video, dedup_frames, describe_images, describe_images_parallel, generate_instructions, instructions_markdown
+)
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".webm", ".m4v")
+CHECKPOINT_NAME = "batch_checkpoint.jsonl"
+
+
+def _init_worker():
+    # Spawned workers start without Django, forked ones already have it and this is a no-op
+    django.setup()
+
+
+def _fingerprint(video_path):
+    stat = os.stat(video_path)
+    return {"video": os.path.abspath(video_path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def process_video(video_path, context, output_path, model_concurrency, frame_mode):
+    stages = {}
+    calls_before = llm.timing_stats()["calls"]
+
+    def stage(name, func, *args, **kwargs):
+        started = time.perf_counter()
+        value = func(*args, **kwargs)
+        stages[name] = time.perf_counter() - started
+        return value
+
+    with tempfile.TemporaryDirectory(prefix="v2i-batch-") as frame_dir:
+        frames = stage("handle_video", handle_video, video_path, mode=frame_mode, frame_dir=frame_dir)
+        if settings.FRAME_DEDUP:
+            frames = stage("dedup_frames", dedup_frames, frames)
+
+        if model_concurrency > 1:
+            descriptions = stage(
+                "describe_images", describe_images_parallel, frames, context, concurrency=model_concurrency
+            )
+        else:
+            descriptions = stage("describe_images", describe_images, frames, context)
+
+        instructions = stage("generate_instructions", generate_instructions, descriptions)
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(instructions_markdown(instructions))
+
+    return {
+        **_fingerprint(video_path),
+        "output": output_path,
+        "frames": len(frames),
+        "instructions": len(instructions),
+        "model_calls": llm.timing_stats()["calls"] - calls_before,
+        "stages": stages,
+    }
+
+
+class Command(BaseCommand):
+    help = "Convert a directory or manifest of videos into Markdown instructions without the browser flow."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "source",
+            help="Directory of videos, or a manifest: a JSON list of paths or {\"video\", \"context\"} "
+                 "objects, or a text file with one path per line"
+        )
+        parser.add_argument("--output", required=True, help="Directory for the Markdown files and the checkpoint")
+        parser.add_argument("--context", default="", help="Context for videos the manifest gives none for")
+        parser.add_argument("--workers", type=int, default=1, help="Videos processed in parallel processes")
+        parser.add_argument(
+            "--model-concurrency", type=int, default=1,
+            help="Model calls in flight per video, above 1 frames are described independently"
+        )
+        parser.add_argument("--frame-mode", default=None, help="Frame selection mode passed to handle_video")
+        parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and process every video")
+
+    def handle(self, *args, **options):
+        entries, base = self._entries(options["source"], options["context"])
+        output = os.path.abspath(options["output"])
+        os.makedirs(output, exist_ok=True)
+
+        checkpoint_path = os.path.join(output, CHECKPOINT_NAME)
+        done = {} if options["restart"] else self._load_checkpoint(checkpoint_path)
+
+        pending = []
+        for video_path, context in entries:
+            output_path = self._output_path(video_path, base, output)
+            record = done.get(os.path.abspath(video_path))
+            if record and self._unchanged(record, video_path) and os.path.exists(output_path):
+                continue
+            pending.append((video_path, context, output_path))
+
+        skipped = len(entries) - len(pending)
+        self.stdout.write(f"{len(entries)} videos, {skipped} already done, {len(pending)} to process")
+
+        started = time.perf_counter()
+        results = []
+        failures = []
+
+        # Forked workers must not share the parent's database connection
+        connections.close_all()
+
+        with open(checkpoint_path, "a", encoding="utf-8") as checkpoint:
+            with ProcessPoolExecutor(max_workers=options["workers"], initializer=_init_worker) as executor:
+                futures = {
+                    executor.submit(
+                        process_video, video_path, context, output_path,
+                        options["model_concurrency"], options["frame_mode"]
+                    ): video_path
+                    for video_path, context, output_path in pending
+                }
+
+                for future in as_completed(futures):
+                    video_path = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        failures.append(video_path)
+                        self.stderr.write(self.style.ERROR(f"{video_path}: {e}"))
+                        continue
+
+                    # One line per finished video, an interrupted batch resumes after the last one written
+                    checkpoint.write(json.dumps(result) + "\n")
+                    checkpoint.flush()
+                    results.append(result)
+                    self.stdout.write(
+                        f"{video_path}: {result['frames']} frames, {result['instructions']} instructions "
+                        f"in {sum(result['stages'].values()):.1f} s"
+                    )
+
+        self._summary(results, skipped, failures, time.perf_counter() - started)
+        if failures:
+            raise CommandError(f"{len(failures)} videos failed, rerun the command to retry them")
+
+    def _entries(self, source, default_context):
+        if os.path.isdir(source):
+            paths = []
+            for root, _, files in os.walk(source):
+                paths.extend(os.path.join(root, name) for name in files if name.lower().endswith(VIDEO_EXTENSIONS))
+            return [(path, default_context) for path in sorted(paths)], os.path.abspath(source)
+
+        if not os.path.isfile(source):
+            raise CommandError(f"{source} is neither a directory nor a manifest file")
+
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source, "r", encoding="utf-8") as f:
+            if source.lower().endswith(".json"):
+                items = json.load(f)
+            else:
+                items = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+        entries = []
+        for item in items:
+            if isinstance(item, str):
+                item = {"video": item}
+            entries.append((os.path.join(base, item["video"]), item.get("context", default_context)))
+        return entries, base
+
+    def _output_path(self, video_path, base, output):
+        relative = os.path.relpath(os.path.abspath(video_path), base)
+        if relative.startswith(os.pardir):
+            relative = os.path.basename(video_path)
+        return os.path.join(output, os.path.splitext(relative)[0] + ".md")
+
+    def _load_checkpoint(self, path):
+        done = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    done[record["video"]] = record
+        return done
+
+    def _unchanged(self, record, video_path):
+        if not os.path.exists(video_path):
+            return False
+        current = _fingerprint(video_path)
+        return record["size"] == current["size"] and record["mtime"] == current["mtime"]
+
+    def _summary(self, results, skipped, failures, elapsed):
+        frames = sum(result["frames"] for result in results)
+        stages = {}
+        for result in results:
+            for name, seconds in result["stages"].items():
+                stages[name] = stages.get(name, 0.0) + seconds
+
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"Processed {len(results)} videos ({skipped} skipped, {len(failures)} failed) in {elapsed:.1f} s"
+        ))
+        if not results:
+            return
+
+        self.stdout.write(
+            f"  {len(results) / elapsed * 3600:.1f} videos/hour, {frames / elapsed:.2f} frames/s, "
+            f"{sum(result['model_calls'] for result in results)} model calls, "
+            f"{sum(result['instructions'] for result in results)} instructions"
+        )
+        for name, seconds in stages.items():
+            self.stdout.write(f"  {name:<24} {seconds:8.2f} s total   {seconds / len(results):8.2f} s per video")
@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import shutil
+import resource
+import tracemalloc
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app import llm
+from app.frames import preprocess_stats
+from app.utils import handle_video, dedup_frames, describe_images, generate_instructions, refine_instructions
+from app.workspace import create_workspace, workspace_dir, frames_dir
+
+
+class Command(BaseCommand):
+    help = "Benchmark the video to instruction pipeline against a stubbed model backend."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "videos", nargs="*",
+            help="Videos to process (defaults to the bundled test videos in MEDIA_ROOT)"
+        )
+        parser.add_argument("--latency", type=float, default=0.05, help="Seconds per stubbed model call")
+        parser.add_argument("--image-latency", type=float, default=0.02, help="Extra seconds per attached image")
+        parser.add_argument("--frame-mode", default=None, help="Frame selection mode passed to handle_video")
+        parser.add_argument("--repeat", type=int, default=1, help="Runs per video")
+        parser.add_argument("--use-cache", action="store_true", help="Keep the model response cache enabled")
+        parser.add_argument("--real-backend", action="store_true", help="Use the configured backend instead of the stub")
+        parser.add_argument("--json", dest="json_path", help="Also write the results to this JSON file")
+
+    def handle(self, *args, **options):
+        if not options["real_backend"]:
+            settings.LLM_BACKEND = "fake"
+            settings.FAKE_LLM_LATENCY = options["latency"]
+            settings.FAKE_LLM_IMAGE_LATENCY = options["image_latency"]
+        settings.LLM_CACHE_ENABLED = options["use_cache"]
+        llm.reset_client()
+
+        videos = options["videos"] or [
+            os.path.join(settings.MEDIA_ROOT, "test_video.mp4"),
+            os.path.join(settings.MEDIA_ROOT, "test_video_2.mp4"),
+        ]
+
+        results = []
+        for video_path in videos:
+            for run in range(options["repeat"]):
+                result = self._run(video_path, options["frame_mode"])
+                result["run"] = run + 1
+                results.append(result)
+                self._report(result)
+
+        if options["json_path"]:
+            with open(options["json_path"], "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Results written to {options['json_path']}")
+
+    def _stage(self, stages, name, func, *args, **kwargs):
+        tracemalloc.start()
+        started = time.perf_counter()
+        value = func(*args, **kwargs)
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        stages[name] = {"seconds": elapsed, "peak_python_mb": peak / 1e6}
+        return value
+
+    def _run(self, video_path, frame_mode):
+        workspace_id = create_workspace()
+        stages = {}
+        encoded_before = preprocess_stats()["model_bytes"]
+        calls_before = llm.timing_stats()["calls"]
+
+        try:
+            frames = self._stage(
+                stages, "handle_video", handle_video, video_path, mode=frame_mode, frame_dir=frames_dir(workspace_id)
+            )
+            if settings.FRAME_DEDUP:
+                frames = self._stage(stages, "dedup_frames", dedup_frames, frames)
+            descriptions = self._stage(stages, "describe_images", describe_images, frames, "Benchmark run")
+            instructions = self._stage(stages, "generate_instructions", generate_instructions, descriptions)
+            self._stage(stages, "refine_instructions", refine_instructions, instructions, "Make them shorter")
+        finally:
+            shutil.rmtree(workspace_dir(workspace_id), ignore_errors=True)
+
+        total = sum(stage["seconds"] for stage in stages.values())
+        return {
+            "video": os.path.basename(video_path),
+            "frames": len(frames),
+            "instructions": len(instructions),
+            "stages": stages,
+            "total_seconds": total,
+            "decode_fps": len(frames) / stages["handle_video"]["seconds"] if frames else 0.0,
+            "describe_fps": len(frames) / stages["describe_images"]["seconds"] if frames else 0.0,
+            "encoded_bytes": preprocess_stats()["model_bytes"] - encoded_before,
+            "model_calls": llm.timing_stats()["calls"] - calls_before,
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+
+    def _report(self, result):
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"{result['video']} (run {result['run']}): {result['frames']} frames, "
+            f"{result['instructions']} instructions, {result['model_calls']} model calls"
+        ))
+        for name, stage in result["stages"].items():
+            self.stdout.write(f"  {name:<24} {stage['seconds']:8.2f} s   peak {stage['peak_python_mb']:8.1f} MB")
+        self.stdout.write(
+            f"  {'total':<24} {result['total_seconds']:8.2f} s   "
+            f"decode {result['decode_fps']:.1f} frames/s, describe {result['describe_fps']:.1f} frames/s, "
+            f"{result['encoded_bytes'] / 1e6:.2f} MB encoded, max RSS {result['max_rss_mb']:.0f} MB"
+        )
@@ -0,0 +1,135 @@
+import json
+import time
+import logging
+import threading
+import contextvars
+
+from contextlib import contextmanager
+
+job_id_var = contextvars.ContextVar("job_id", default=None)
+
+BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_help = {
+    "v2i_stage_seconds": ("histogram", "Time spent in each pipeline stage."),
+    "v2i_model_call_seconds": ("histogram", "Latency of model calls by operation and backend."),
+    "v2i_model_calls_total": ("counter", "Model calls by operation and outcome."),
+    "v2i_model_retries_total": ("counter", "Model calls retried after a bad response."),
+    "v2i_parse_failures_total": ("counter", "Model responses that could not be parsed."),
+    "v2i_jobs_total": ("counter", "Describe jobs by final status."),
+    "v2i_suggestion_lookups_total": ("counter", "Precomputed add_instruction suggestions found or missed."),
+}
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with _lock:
+        key = (name, _key(labels))
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    with _lock:
+        key = (name, _key(labels))
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+
+@contextmanager
+def timer(stage, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("v2i_stage_seconds", time.perf_counter() - started, stage=stage, **labels)
+
+
+def timed_iter(iterable, stage, **labels):
+    # Only the time spent producing items counts, not the time the consumer holds on to them
+    elapsed = 0.0
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            break
+        finally:
+            elapsed += time.perf_counter() - started
+        yield item
+    observe("v2i_stage_seconds", elapsed, stage=stage, **labels)
+
+
+def _labels(labels, **extra):
+    items = list(labels) + sorted(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in items) + "}"
+
+
+def render(extra=None):
+    lines = []
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: {**h, "buckets": list(h["buckets"])} for key, h in _histograms.items()}
+
+    for name, (kind, description) in _help.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f"{name}{_labels(labels)} {value}")
+        for (metric, labels), histogram in sorted(histograms.items()):
+            if metric != name:
+                continue
+            for bound, count in zip(BUCKETS, histogram["buckets"]):
+                lines.append(f"{name}_bucket{_labels(labels, le=bound)} {count}")
+            lines.append(f"{name}_bucket{_labels(labels, le='+Inf')} {histogram['count']}")
+            lines.append(f"{name}_sum{_labels(labels)} {histogram['sum']:.6f}")
+            lines.append(f"{name}_count{_labels(labels)} {histogram['count']}")
+
+    for name, (kind, description, value) in (extra or {}).items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+class JobIdFilter(logging.Filter):
+    def filter(self, record):
+        if not getattr(record, "job_id", None):
+            record.job_id = job_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    _reserved = set(vars(logging.makeLogRecord({}))) | {"message", "job_id"}
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "job_id", None):
+            entry["job_id"] = record.job_id
+        for key, value in vars(record).items():
+            if key not in self._reserved:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
@@ -0,0 +1,114 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:06
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_upload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Video',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('workspace_id', models.CharField(db_index=True, max_length=64)),
+                ('path', models.CharField(db_index=True, max_length=1024)),
+                ('filename', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['created_at'],
+            },
+        ),
+        migrations.RemoveField(
+            model_name='job',
+            name='result',
+        ),
+        migrations.CreateModel(
+            name='Frame',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('position', models.PositiveIntegerField(default=0)),
+                ('timestamp', models.FloatField(default=0.0)),
+                ('path', models.CharField(max_length=1024)),
+                ('url', models.CharField(max_length=1024)),
+                ('hash', models.CharField(blank=True, db_index=True, default='', max_length=16)),
+                ('range_start', models.PositiveIntegerField(blank=True, null=True)),
+                ('range_end', models.PositiveIntegerField(blank=True, null=True)),
+                ('merged_urls', models.JSONField(blank=True, default=list)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='frames', to='app.job')),
+            ],
+            options={
+                'ordering': ['job', 'index'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Description',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('text', models.TextField()),
+                ('deleted', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('frame', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='description', to='app.frame')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='InstructionVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('source', models.CharField(choices=[('generated', 'Generated'), ('saved', 'Saved')], max_length=16)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='instruction_versions', to='app.job')),
+            ],
+            options={
+                'ordering': ['job', 'number'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Instruction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('text', models.TextField()),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='instructions', to='app.instructionversion')),
+            ],
+            options={
+                'ordering': ['version', 'index'],
+            },
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='video',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='jobs', to='app.video'),
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='video',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='uploads', to='app.video'),
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['video', 'context', 'status'], name='app_job_video_i_fc58da_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='frame',
+            constraint=models.UniqueConstraint(fields=('job', 'index'), name='unique_frame_index'),
+        ),
+        migrations.AddConstraint(
+            model_name='instructionversion',
+            constraint=models.UniqueConstraint(fields=('job', 'number'), name='unique_instruction_version'),
+        ),
+        migrations.AddConstraint(
+            model_name='instruction',
+            constraint=models.UniqueConstraint(fields=('version', 'index'), name='unique_instruction_index'),
+        ),
+    ]
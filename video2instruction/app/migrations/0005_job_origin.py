@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_video_frame_description_instruction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='origin',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='copies', to='app.job'),
+        ),
+    ]
@@ -1,3 +1,232 @@
-from django.db import models
+import uuid
 
-# Create your models here.
+from django.db import models, transaction
+from django.utils import timezone
+
+
+class Video(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    sha256 = models.CharField(max_length=64, unique=True)
+    workspace_id = models.CharField(max_length=64, db_index=True)
+    path = models.CharField(max_length=1024, db_index=True)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["created_at"]
+
+    def __str__(self):
+        return f"{self.filename} ({self.sha256[:12]})"
+
+
+class Job(models.Model):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    workspace_id = models.CharField(max_length=64, blank=True, default="", db_index=True)
+    video = models.ForeignKey(Video, null=True, blank=True, on_delete=models.SET_NULL, related_name="jobs")
+    origin = models.ForeignKey("self", null=True, blank=True, on_delete=models.CASCADE, related_name="copies")
+    video_path = models.CharField(max_length=1024)
+    context = models.TextField(blank=True, default="")
+    progress = models.FloatField(default=0.0)
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["created_at"]
+        indexes = [models.Index(fields=["video", "context", "status"])]
+
+    def __str__(self):
+        return f"{self.id} ({self.status})"
+
+    def descriptions(self, start=0):
+        frames = (
+            self.frames.filter(index__gte=start, description__isnull=False, description__deleted=False)
+            .select_related("description")
+        )
+        return [frame.as_item() for frame in frames]
+
+    def record_description(self, index, item):
+        with transaction.atomic():
+            frame = Frame.from_item(self, index, item)
+            frame.save()
+            Description.objects.create(frame=frame, text=item["description"])
+
+    def copy(self):
+        # Finished jobs are shared by every upload of the same video and context, so a
+        # session edits its own copy and the original keeps the model's descriptions
+        with transaction.atomic():
+            job = Job.objects.create(
+                status=self.status,
+                workspace_id=self.workspace_id,
+                video=self.video,
+                origin=self,
+                video_path=self.video_path,
+                context=self.context,
+                progress=self.progress
+            )
+            frames = list(self.frames.filter(description__isnull=False).select_related("description"))
+            copies = Frame.objects.bulk_create(Frame.from_item(job, frame.index, frame.as_item()) for frame in frames)
+            Description.objects.bulk_create(
+                Description(frame=copy, text=frame.description.text, deleted=frame.description.deleted)
+                for copy, frame in zip(copies, frames)
+            )
+        return job
+
+    def update_descriptions(self, edits):
+        # edits maps a frame index to its (text, deleted) pair, only rows that changed are written
+        changed = []
+        now = timezone.now()
+        for description in Description.objects.filter(frame__job=self, frame__index__in=edits).select_related("frame"):
+            text, deleted = edits[description.frame.index]
+            if description.text != text or description.deleted != deleted:
+                description.text = text
+                description.deleted = deleted
+                description.updated_at = now
+                changed.append(description)
+
+        Description.objects.bulk_update(changed, ["text", "deleted", "updated_at"])
+        return len(changed)
+
+
+class Upload(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    sha256 = models.CharField(max_length=64, blank=True, default="", db_index=True)
+    workspace_id = models.CharField(max_length=64, db_index=True)
+    video_path = models.CharField(max_length=1024)
+    video = models.ForeignKey(Video, null=True, blank=True, on_delete=models.SET_NULL, related_name="uploads")
+    completed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["created_at"]
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size})"
+
+
+class Frame(models.Model):
+    job = models.ForeignKey(Job, on_delete=models.CASCADE, related_name="frames")
+    index = models.PositiveIntegerField()
+    position = models.PositiveIntegerField(default=0)
+    timestamp = models.FloatField(default=0.0)
+    path = models.CharField(max_length=1024)
+    url = models.CharField(max_length=1024)
+    hash = models.CharField(max_length=16, blank=True, default="", db_index=True)
+    range_start = models.PositiveIntegerField(null=True, blank=True)
+    range_end = models.PositiveIntegerField(null=True, blank=True)
+    merged_urls = models.JSONField(default=list, blank=True)
+
+    class Meta:
+        ordering = ["job", "index"]
+        constraints = [models.UniqueConstraint(fields=["job", "index"], name="unique_frame_index")]
+
+    def __str__(self):
+        return f"{self.job_id} #{self.index}"
+
+    @classmethod
+    def from_item(cls, job, index, item):
+        frame_range = item.get("range") or [None, None]
+        return cls(
+            job=job,
+            index=index,
+            position=item.get("position", 0),
+            timestamp=item.get("timestamp", 0.0),
+            path=item["path"],
+            url=item["url"],
+            hash=item.get("hash", ""),
+            range_start=frame_range[0],
+            range_end=frame_range[1],
+            merged_urls=item.get("frames", [])
+        )
+
+    def as_item(self):
+        item = {
+            "index": self.index,
+            "path": self.path,
+            "url": self.url,
+            "position": self.position,
+            "timestamp": self.timestamp,
+            "description": self.description.text
+        }
+        if self.hash:
+            item.update(hash=self.hash, range=[self.range_start, self.range_end], frames=self.merged_urls)
+        return item
+
+
+class Description(models.Model):
+    frame = models.OneToOneField(Frame, on_delete=models.CASCADE, related_name="description")
+    text = models.TextField()
+    deleted = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.text[:50]
+
+
+class InstructionVersion(models.Model):
+    GENERATED = "generated"
+    SAVED = "saved"
+
+    SOURCE_CHOICES = [
+        (GENERATED, "Generated"),
+        (SAVED, "Saved"),
+    ]
+
+    job = models.ForeignKey(Job, on_delete=models.CASCADE, related_name="instruction_versions")
+    number = models.PositiveIntegerField()
+    source = models.CharField(max_length=16, choices=SOURCE_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["job", "number"]
+        constraints = [models.UniqueConstraint(fields=["job", "number"], name="unique_instruction_version")]
+
+    def __str__(self):
+        return f"{self.job_id} v{self.number} ({self.source})"
+
+    def texts(self):
+        return list(self.instructions.values_list("text", flat=True))
+
+    @classmethod
+    def record(cls, job, texts, source):
+        latest = job.instruction_versions.order_by("-number").first()
+        if latest is not None and latest.texts() == texts:
+            return latest
+
+        with transaction.atomic():
+            version = cls.objects.create(job=job, number=latest.number + 1 if latest else 1, source=source)
+            Instruction.objects.bulk_create(
+                Instruction(version=version, index=index, text=text) for index, text in enumerate(texts)
+            )
+        return version
+
+
+class Instruction(models.Model):
+    version = models.ForeignKey(InstructionVersion, on_delete=models.CASCADE, related_name="instructions")
+    index = models.PositiveIntegerField()
+    text = models.TextField()
+
+    class Meta:
+        ordering = ["version", "index"]
+        constraints = [models.UniqueConstraint(fields=["version", "index"], name="unique_instruction_index")]
+
+    def __str__(self):
+        return self.text[:50]
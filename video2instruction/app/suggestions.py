@@ -0,0 +1,104 @@
+import json
+import asyncio
+import logging
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .metrics import inc
+from .utils import add_instruction, target_description_for
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=settings.ADD_INSTRUCTION_PRECOMPUTE_WORKERS, thread_name_prefix="suggestion")
+_lock = threading.Lock()
+_suggestions = {}
+# Sessions on the same video ask for the same keys, a suggestion lives as long as one job holds it
+_holders = {}
+_job_keys = OrderedDict()
+
+
+def suggestion_key(current_instructions, insert_index, descriptions):
+    # Only the neighbors and the matching description decide the suggestion, so edits
+    # elsewhere in the list keep it valid and a changed neighbor makes it miss
+    before = current_instructions[insert_index - 1] if insert_index > 0 else None
+    after = current_instructions[insert_index] if insert_index < len(current_instructions) else None
+    return json.dumps([settings.LLM_MODEL, before, after, target_description_for(insert_index, descriptions)])
+
+
+def _release(key, job_id):
+    holders = _holders.get(key)
+    if holders is None:
+        return
+    holders.discard(job_id)
+    if holders:
+        return
+
+    del _holders[key]
+    future = _suggestions.pop(key, None)
+    if future is not None:
+        future.cancel()
+
+
+def _release_job(job_id):
+    for key in _job_keys.pop(job_id, set()):
+        _release(key, job_id)
+
+
+def precompute(job_id, current_instructions, descriptions):
+    current_instructions = list(current_instructions)
+    keys = []
+    scheduled = 0
+
+    with _lock:
+        for insert_index in range(len(current_instructions) + 1):
+            key = suggestion_key(current_instructions, insert_index, descriptions)
+            keys.append(key)
+            _holders.setdefault(key, set()).add(job_id)
+            if key in _suggestions:
+                continue
+
+            _suggestions[key] = _executor.submit(
+                add_instruction, current_instructions, insert_index, descriptions, label="add_instruction precompute"
+            )
+            scheduled += 1
+
+        # Gaps that no longer exist in this job's list won't be asked for by it, other jobs
+        # may still want them
+        for key in _job_keys.pop(job_id, set()) - set(keys):
+            _release(key, job_id)
+        _job_keys[job_id] = set(keys)
+
+        # Over the limit, the jobs that precomputed least recently give up their suggestions
+        while len(_job_keys) > 1 and (
+            len(_suggestions) > settings.ADD_INSTRUCTION_SUGGESTIONS_MAX
+            or len(_job_keys) > settings.ADD_INSTRUCTION_SUGGESTIONS_MAX
+        ):
+            _release_job(next(iter(_job_keys)))
+
+    if scheduled:
+        logger.info(f"Precomputing {scheduled} add_instruction suggestions", extra={"job_id": str(job_id)})
+    return scheduled
+
+
+async def aget_suggestion(current_instructions, insert_index, descriptions):
+    key = suggestion_key(current_instructions, insert_index, descriptions)
+    with _lock:
+        future = _suggestions.get(key)
+
+    if future is None or future.cancelled():
+        inc("v2i_suggestion_lookups_total", outcome="miss")
+        return None
+
+    # A suggestion still being computed is awaited, it is already ahead of a fresh call
+    try:
+        suggestion = await asyncio.wrap_future(future)
+    except Exception as e:
+        logger.warning(f"Precomputed suggestion failed: {e}")
+        suggestion = None
+
+    inc("v2i_suggestion_lookups_total", outcome="hit" if suggestion else "miss")
+    return suggestion or None
@@ -1,3 +1,580 @@
-from django.test import TestCase
+import io
+import os
+import time
+import shutil
+import asyncio
+import hashlib
+import tempfile
+import threading
 
-# Create your tests here.
+from datetime import timedelta
+
+import cv2
+import numpy as np
+
+from unittest import mock
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.urls import reverse
+from django.utils import timezone
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from . import cache as llm_cache
+from . import jobs, llm, suggestions
+from .frames import encode_frame, preprocess_stats
+from .jobs import _run_describe_job, poll_job_events, astream_job_events
+from .models import Job, Video, Frame
+from .uploads import start_upload, append_chunk, complete_upload, register_video
+from .workspace import create_workspace, workspace_dir
+from .utils import (
+    _repair_instruction_set, _complete_instructions, _instruction_windows, _select_keyframes, _frames_at,
+    _sampled_frames, _dhash, _hamming, _generate, dedup_frames, estimate_tokens, handle_video, refine_instructions,
+    arefine_instructions_incremental
+)
+
+
+TEST_VIDEO = os.path.join(settings.BASE_DIR, "media", "test_video_2.mp4")
+
+FAKE_BACKEND = override_settings(LLM_BACKEND="fake", LLM_ENDPOINTS=[], LLM_CACHE_ENABLED=False, FAKE_LLM_LATENCY=0.0)
+
+
+def use_fake_backend(test):
+    llm.reset_client()
+    test.addCleanup(llm.reset_client)
+
+
+def use_temporary_media(test):
+    media_root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+    override = override_settings(MEDIA_ROOT=media_root)
+    override.enable()
+    test.addCleanup(override.disable)
+
+
+def use_temporary_cache(test):
+    cache_dir = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+    override = override_settings(LLM_CACHE_ENABLED=True, LLM_CACHE_PATH=os.path.join(cache_dir, "llm_cache.sqlite3"))
+    override.enable()
+    test.addCleanup(override.disable)
+
+
+@FAKE_BACKEND
+class FakeBackendTestCase(SimpleTestCase):
+    def setUp(self):
+        use_fake_backend(self)
+
+
+class RepairInstructionSetTests(SimpleTestCase):
+    def test_object_in_code_fence_with_trailing_comma(self):
+        raw = 'Sure:\n```json\n{"instructions": ["Open the box.", "Take out the cup.",]}\n```'
+        self.assertEqual(_repair_instruction_set(raw), ["Open the box.", "Take out the cup."])
+
+    def test_bare_list(self):
+        self.assertEqual(_repair_instruction_set('["One.", " Two. "]'), ["One.", "Two."])
+
+    def test_other_list_key_and_item_objects(self):
+        raw = '{"steps": [{"text": "Fold the shirt."}, {"step": 2, "text": "Stack it."}]}'
+        self.assertEqual(_repair_instruction_set(raw), ["Fold the shirt.", "Stack it."])
+
+    def test_no_json(self):
+        with self.assertRaises(ValueError):
+            _repair_instruction_set("I can't help with that.")
+
+
+class CompleteInstructionsTests(SimpleTestCase):
+    def _request(self, *answers):
+        calls = []
+
+        def request(items):
+            calls.append(list(items))
+            return answers[len(calls) - 1]
+
+        return request, calls
+
+    def test_short_answer_retries_only_the_missing_tail(self):
+        request, calls = self._request(["A", "B"], ["C"])
+        result = _complete_instructions(["a", "b", "c"], request, "test", str.upper)
+
+        self.assertEqual(result, ["A", "B", "C"])
+        self.assertEqual(calls, [["a", "b", "c"], ["c"]])
+
+    @override_settings(INSTRUCTION_RETRIES=1)
+    def test_missing_items_fall_back_after_the_retries(self):
+        request, calls = self._request(["A"], None)
+        result = _complete_instructions(["a", "b", "c"], request, "test", lambda item: f"kept {item}")
+
+        self.assertEqual(result, ["A", "kept b", "kept c"])
+        self.assertEqual(len(calls), 2)
+
+    def test_extra_items_are_dropped(self):
+        request, calls = self._request(["A", "B", "C"])
+        self.assertEqual(_complete_instructions(["a", "b"], request, "test", str), ["A", "B"])
+        self.assertEqual(len(calls), 1)
+
+
+class RefineInstructionsTests(FakeBackendTestCase):
+    def test_one_refined_instruction_per_input(self):
+        result = refine_instructions(["Cut the bread", "Butter it"], "Keep it short")
+        self.assertEqual(len(result), 2)
+        self.assertTrue(all(text.startswith("Do step") for text in result))
+
+
+class RefineIncrementalTests(FakeBackendTestCase):
+    def setUp(self):
+        super().setUp()
+        use_temporary_cache(self)
+
+    def _refine(self, instructions):
+        async def collect():
+            return dict([item async for item in arefine_instructions_incremental(instructions, "Keep it short")])
+
+        refined = asyncio.run(collect())
+        return [refined[i] for i in range(len(instructions))]
+
+    def test_unchanged_lines_come_from_the_cache(self):
+        first = self._refine(["Cut the bread", "Butter it"])
+        with mock.patch("app.utils._arequest_instructions") as request:
+            self.assertEqual(self._refine(["Cut the bread", first[1]]), first)
+        request.assert_not_called()
+
+    @override_settings(INSTRUCTION_RETRIES=0)
+    def test_fallback_text_is_not_cached(self):
+        with mock.patch("app.utils._arequest_instructions", return_value=None):
+            self.assertEqual(self._refine(["Cut the bread", "Butter it"]), ["Cut the bread", "Butter it"])
+
+        # Once the model answers again, the lines it missed are refined instead of served as they were
+        result = self._refine(["Cut the bread", "Butter it"])
+        self.assertTrue(all(text.startswith("Do step") for text in result))
+
+
+class PreprocessStatsTests(SimpleTestCase):
+    @override_settings(PREPROCESS_BASELINE_SAMPLE_EVERY=4, MODEL_FRAME_MAX_SIDE=64)
+    def test_baseline_is_sampled_and_scaled_to_all_frames(self):
+        frame = np.random.default_rng(0).integers(0, 255, (240, 320, 3), dtype=np.uint8)
+        before = preprocess_stats()
+        for _ in range(8):
+            encode_frame(frame)
+        stats = preprocess_stats()
+
+        self.assertEqual(stats["frames"] - before["frames"], 8)
+        self.assertEqual(stats["baseline_samples"] - before["baseline_samples"], 2)
+        sampled = stats["baseline_sample_bytes"] - before["baseline_sample_bytes"]
+        self.assertGreater(sampled, 2 * (stats["model_bytes"] - before["model_bytes"]) / 8)
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def setUp(self):
+        use_temporary_cache(self)
+
+    def test_round_trip(self):
+        key = llm_cache.cache_key("model", "prompt")
+        self.assertIsNone(llm_cache.get(key))
+        llm_cache.put(key, "model", "answer")
+        self.assertEqual(llm_cache.get(key), "answer")
+
+    def test_key_covers_model_images_and_options(self):
+        key = llm_cache.cache_key("model", "prompt", ["aW1hZ2U="], format="json")
+        self.assertNotEqual(key, llm_cache.cache_key("other", "prompt", ["aW1hZ2U="], format="json"))
+        self.assertNotEqual(key, llm_cache.cache_key("model", "prompt", ["b3RoZXI="], format="json"))
+        self.assertNotEqual(key, llm_cache.cache_key("model", "prompt", ["aW1hZ2U="]))
+        self.assertEqual(key, llm_cache.cache_key("model", "prompt", ["aW1hZ2U="], format="json"))
+
+    @override_settings(LLM_CACHE_MAX_ENTRIES=2, LLM_CACHE_TOUCH_INTERVAL=0)
+    def test_least_recently_used_entry_is_evicted(self):
+        for key in ("a", "b"):
+            llm_cache.put(key, "model", key)
+            time.sleep(0.01)
+        llm_cache.get("a")
+        time.sleep(0.01)
+        llm_cache.put("c", "model", "c")
+
+        self.assertEqual([llm_cache.get(key) for key in ("a", "b", "c")], ["a", None, "c"])
+
+    @override_settings(LLM_CACHE_ENABLED=False)
+    def test_disabled_cache_stores_nothing(self):
+        llm_cache.put("a", "model", "a")
+        self.assertIsNone(llm_cache.get("a"))
+
+    def test_repeated_request_skips_the_model(self):
+        with mock.patch("app.utils.get_client") as client:
+            client.return_value.generate.return_value = {"response": "A person folds a shirt."}
+            first = _generate("model", "Describe", images=["aW1hZ2U="])
+            second = _generate("model", "Describe", images=["aW1hZ2U="])
+
+        self.assertEqual(first["response"], second["response"])
+        client.return_value.generate.assert_called_once()
+
+
+class InstructionWindowsTests(SimpleTestCase):
+    def _descriptions(self, count, length=40):
+        return [{"description": f"{i:03d} " + "x" * length} for i in range(count)]
+
+    @override_settings(GENERATE_CONTEXT_BUDGET=4096, MODEL_IMAGE_TOKENS=576)
+    def test_windows_keep_order_and_fit_the_budget(self):
+        descriptions = self._descriptions(30)
+        windows = list(_instruction_windows(descriptions, with_images=True))
+
+        self.assertGreater(len(windows), 1)
+        self.assertEqual([item for window in windows for item in window], descriptions)
+        for window in windows:
+            used = sum(estimate_tokens(f"- {item['description']}\n") + 576 for item in window)
+            self.assertLessEqual(used, 4096)
+
+    @override_settings(GENERATE_CONTEXT_BUDGET=4096)
+    def test_text_only_fits_in_one_window(self):
+        self.assertEqual(len(list(_instruction_windows(self._descriptions(30), with_images=False))), 1)
+
+    @override_settings(GENERATE_CONTEXT_BUDGET=10)
+    def test_oversized_item_still_gets_a_window(self):
+        windows = list(_instruction_windows(self._descriptions(2, length=400), with_images=False))
+        self.assertEqual([len(window) for window in windows], [1, 1])
+
+    def test_no_descriptions(self):
+        self.assertEqual(list(_instruction_windows([], with_images=True)), [])
+
+
+class SelectKeyframesTests(SimpleTestCase):
+    def test_selection_within_limits_is_kept(self):
+        self.assertEqual(_select_keyframes([1.0, 0.1, 0.8, 0.2], [2, 0], 1, 5), [0, 2])
+
+    def test_caps_at_max_frames_by_score(self):
+        scores = [1.0, 0.3, 0.9, 0.5, 0.7]
+        self.assertEqual(_select_keyframes(scores, [0, 1, 2, 3, 4], 1, 3), [0, 2, 4])
+
+    def test_fills_up_to_min_frames_with_the_highest_scores(self):
+        scores = [1.0, 0.2, 0.6, 0.1, 0.4]
+        self.assertEqual(_select_keyframes(scores, [0], 3, 10), [0, 2, 4])
+
+
+@override_settings(DECODE_WORKERS=1)
+class SceneKeyframesTests(SimpleTestCase):
+    def setUp(self):
+        use_temporary_media(self)
+
+    @override_settings(KEYFRAME_MIN_FRAMES=3, KEYFRAME_MAX_FRAMES=5)
+    def test_only_the_kept_frames_are_encoded(self):
+        before = preprocess_stats()
+        frames = handle_video(TEST_VIDEO, fps=5, mode="scene", frame_dir=os.path.join(settings.MEDIA_ROOT, "frames"))
+
+        self.assertTrue(3 <= len(frames) <= 5)
+        self.assertEqual(preprocess_stats()["frames"] - before["frames"], len(frames))
+        self.assertEqual([item["position"] for item in frames], sorted(item["position"] for item in frames))
+
+    def test_frames_at_matches_a_sequential_read(self):
+        video = cv2.VideoCapture(TEST_VIDEO)
+        expected = {position: frame for position, frame in _sampled_frames(video, 1)}
+        video.release()
+        positions = [0, 3, 4, len(expected) - 1]
+
+        for seek_interval in (1, 1000):
+            with override_settings(FRAME_SEEK_MIN_INTERVAL=seek_interval):
+                video = cv2.VideoCapture(TEST_VIDEO)
+                frames = list(_frames_at(video, positions))
+                video.release()
+
+            self.assertEqual([position for position, _ in frames], positions)
+            for position, frame in frames:
+                self.assertTrue(np.array_equal(frame, expected[position]), (seek_interval, position))
+
+
+class DedupFramesTests(SimpleTestCase):
+    def _frames(self, hashes):
+        return [{"path": f"{i}.jpg", "url": f"{i}.jpg", "dhash": frame_hash} for i, frame_hash in enumerate(hashes)]
+
+    def test_similar_neighbours_collapse_into_one_run(self):
+        far = 0xFFFF_FFFF_0000_0000
+        runs = dedup_frames(self._frames([0, 1, 3, far, far | 1, 0]), threshold=5)
+
+        self.assertEqual([run["range"] for run in runs], [[0, 2], [3, 4], [5, 5]])
+        self.assertEqual(runs[0]["frames"], ["0.jpg", "1.jpg", "2.jpg"])
+        self.assertEqual(runs[1]["path"], "3.jpg")
+        self.assertTrue(all("dhash" not in run for run in runs))
+
+    def test_runs_compare_against_their_first_frame(self):
+        # Slow drift doesn't chain into one run, each frame is compared with the run's first hash
+        runs = dedup_frames(self._frames([0b0, 0b111, 0b111111]), threshold=3)
+        self.assertEqual([run["range"] for run in runs], [[0, 1], [2, 2]])
+
+    def test_dhash_ignores_brightness_but_not_content(self):
+        gradient = np.tile(np.arange(0, 192, 3, dtype=np.uint8), (48, 1))
+        frame = cv2.cvtColor(gradient, cv2.COLOR_GRAY2BGR)
+
+        self.assertEqual(_dhash(frame), _dhash(frame + 20))
+        self.assertGreater(_hamming(_dhash(frame), _dhash(frame[:, ::-1])), 32)
+
+
+class AppendChunkTests(TestCase):
+    def setUp(self):
+        use_temporary_media(self)
+
+        self.data = os.urandom(1000)
+        self.upload = start_upload("video.mp4", len(self.data))
+
+    def _partial(self):
+        with open(self.upload.video_path + ".part", "rb") as f:
+            return f.read()
+
+    def test_chunks_append_in_order_and_complete_with_the_hash(self):
+        append_chunk(self.upload, 0, io.BytesIO(self.data[:400]))
+        upload = append_chunk(self.upload, 400, io.BytesIO(self.data[400:]))
+        self.assertEqual(upload.received, 1000)
+
+        upload = complete_upload(upload)
+        self.assertEqual(upload.sha256, hashlib.sha256(self.data).hexdigest())
+        with open(upload.video_path, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_wrong_offset_is_rejected(self):
+        append_chunk(self.upload, 0, io.BytesIO(self.data[:400]))
+        with self.assertRaises(ValueError):
+            append_chunk(self.upload, 300, io.BytesIO(self.data[300:]))
+
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.received, 400)
+
+    def test_bytes_past_the_acknowledged_offset_are_dropped(self):
+        append_chunk(self.upload, 0, io.BytesIO(self.data[:400]))
+        # An interrupted request left bytes on disk that were never acknowledged
+        with open(self.upload.video_path + ".part", "ab") as f:
+            f.write(b"garbage")
+
+        append_chunk(self.upload, 400, io.BytesIO(self.data[400:]))
+        self.assertEqual(self._partial(), self.data)
+
+    def test_chunk_past_the_declared_size_is_rejected(self):
+        with self.assertRaises(ValueError):
+            append_chunk(self.upload, 0, io.BytesIO(self.data + b"extra"))
+
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.received, 0)
+
+    def test_incomplete_upload_cannot_complete(self):
+        append_chunk(self.upload, 0, io.BytesIO(self.data[:400]))
+        with self.assertRaises(ValueError):
+            complete_upload(self.upload)
+
+
+class RegisterVideoTests(TestCase):
+    def setUp(self):
+        use_temporary_media(self)
+
+    def _video_file(self, workspace_id):
+        path = os.path.join(workspace_dir(workspace_id), "video.mp4")
+        with open(path, "wb") as f:
+            f.write(b"video")
+        return path
+
+    def test_duplicate_content_shares_the_first_workspace(self):
+        first = create_workspace()
+        video = register_video("abc", first, self._video_file(first), "a.mp4", 5)
+
+        second = create_workspace()
+        self.assertEqual(register_video("abc", second, self._video_file(second), "b.mp4", 5), video)
+        self.assertFalse(os.path.exists(workspace_dir(second)))
+
+    def test_concurrent_registration_reuses_the_winner(self):
+        first = create_workspace()
+        winner = register_video("abc", first, self._video_file(first), "a.mp4", 5)
+
+        # The other upload checked for the hash before the winner saved it
+        lookup = Video.objects.filter
+        missed = mock.Mock(**{"first.return_value": None})
+        second = create_workspace()
+        with mock.patch.object(Video.objects, "filter", side_effect=[missed, lookup(sha256="abc")]):
+            video = register_video("abc", second, self._video_file(second), "b.mp4", 5)
+
+        self.assertEqual(video, winner)
+        self.assertEqual(Video.objects.count(), 1)
+
+
+class UploadViewTests(TestCase):
+    def setUp(self):
+        use_temporary_media(self)
+
+    def test_start_rejects_malformed_json(self):
+        response = self.client.post(reverse("upload_start"), "{", content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_complete_rejects_malformed_json_before_completing(self):
+        upload = start_upload("video.mp4", 5)
+        append_chunk(upload, 0, io.BytesIO(b"video"))
+
+        response = self.client.post(reverse("upload_complete", args=[upload.pk]), "{", content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        upload.refresh_from_db()
+        self.assertIsNone(upload.completed_at)
+
+
+class JobStreamTests(TestCase):
+    def _job(self, status, count):
+        job = Job.objects.create(workspace_id="w", video_path=TEST_VIDEO, status=status, progress=0.5)
+        for index in range(count):
+            job.record_description(index, {"path": f"{index}.jpg", "url": f"{index}.jpg", "description": f"Step {index}"})
+        return job
+
+    def _event_ids(self, events):
+        return [line[4:] for event in events for line in event.splitlines() if line.startswith("id: ")]
+
+    def test_poll_sends_new_descriptions_and_asks_to_reconnect(self):
+        job = self._job(Job.RUNNING, 2)
+        events = poll_job_events(job.pk)
+
+        self.assertEqual(self._event_ids(events), ["1", "2"])
+        self.assertIn("event: progress", events[-2])
+        self.assertEqual(events[-1], f"retry: {settings.JOB_POLL_RETRY_MS}\n\n")
+
+    def test_poll_resumes_after_the_last_event_id(self):
+        job = self._job(Job.DONE, 3)
+        events = poll_job_events(job.pk, sent=2)
+
+        self.assertEqual(self._event_ids(events), ["3"])
+        self.assertIn("event: done", events[-1])
+
+    def test_view_reads_last_event_id(self):
+        job = self._job(Job.DONE, 2)
+        response = self.client.get(reverse("job_stream", args=[job.pk]), headers={"Last-Event-ID": "1"})
+
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertEqual(self._event_ids([response.content.decode()]), ["2"])
+
+    async def test_stream_ends_with_the_job(self):
+        job = await sync_to_async(self._job)(Job.FAILED, 1)
+        await Job.objects.filter(pk=job.pk).aupdate(error="boom")
+        events = [event async for event in astream_job_events(job.pk)]
+
+        self.assertEqual(self._event_ids(events), ["1"])
+        self.assertIn('"boom"', events[-1])
+
+    @override_settings(JOB_STREAM_STALL_TIMEOUT=0, JOB_STREAM_POLL_INTERVAL=0.01)
+    async def test_stream_gives_up_on_a_stalled_job(self):
+        job = await sync_to_async(self._job)(Job.RUNNING, 0)
+        with mock.patch("app.jobs._executor"):
+            events = [event async for event in astream_job_events(job.pk)]
+
+        self.assertIn("event: stalled", events[-1])
+
+
+class PrecomputeSuggestionsTests(SimpleTestCase):
+    def setUp(self):
+        for name, value in (("_suggestions", {}), ("_holders", {}), ("_job_keys", OrderedDict())):
+            patcher = mock.patch.object(suggestions, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(suggestions, "_executor")
+        patcher.start().submit.side_effect = lambda *args, **kwargs: Future()
+        self.addCleanup(patcher.stop)
+
+        self.descriptions = ["Take the shirt", "Fold it", "Stack it"]
+        self.texts = ["Take the shirt.", "Fold it.", "Stack it."]
+
+    def _future(self, texts, insert_index):
+        return suggestions._suggestions.get(suggestions.suggestion_key(texts, insert_index, self.descriptions))
+
+    def test_shared_suggestion_outlives_one_job_dropping_it(self):
+        suggestions.precompute("a", self.texts, self.descriptions)
+        self.assertEqual(suggestions.precompute("b", self.texts, self.descriptions), 0)
+        shared = self._future(self.texts, 2)
+
+        edited = ["Take the shirt.", "Smooth it.", "Stack it."]
+        suggestions.precompute("a", edited, self.descriptions)
+        self.assertIs(self._future(self.texts, 2), shared)
+        self.assertFalse(shared.cancelled())
+
+        suggestions.precompute("b", edited, self.descriptions)
+        self.assertIsNone(self._future(self.texts, 2))
+        self.assertTrue(shared.cancelled())
+
+    @override_settings(ADD_INSTRUCTION_SUGGESTIONS_MAX=4)
+    def test_least_recent_job_gives_up_its_suggestions(self):
+        suggestions.precompute("a", self.texts, self.descriptions)
+        old = self._future(self.texts, 0)
+
+        other = ["Open the box.", "Take out the cup.", "Close the box."]
+        suggestions.precompute("b", other, self.descriptions)
+
+        self.assertTrue(old.cancelled())
+        self.assertEqual(list(suggestions._job_keys), ["b"])
+        self.assertEqual(len(suggestions._suggestions), 4)
+
+
+# The job saves from the worker's own threads, so these tests need committed data
+@FAKE_BACKEND
+@override_settings(FRAME_DEDUP=False, DECODE_WORKERS=1)
+class DescribeJobTests(TransactionTestCase):
+    def setUp(self):
+        use_fake_backend(self)
+        use_temporary_media(self)
+
+    def _run(self):
+        job = Job.objects.create(workspace_id=create_workspace(), video_path=TEST_VIDEO, context="folding")
+        _run_describe_job(job)
+        job.refresh_from_db()
+        return job
+
+    def _assert_described(self, job):
+        self.assertEqual(job.status, Job.DONE, job.error)
+        self.assertEqual(job.progress, 1.0)
+
+        descriptions = job.descriptions()
+        self.assertGreater(len(descriptions), 0)
+        self.assertEqual([item["index"] for item in descriptions], list(range(len(descriptions))))
+        self.assertTrue(all(os.path.exists(item["path"]) for item in descriptions))
+
+    @override_settings(DESCRIBE_MODE="sequential")
+    def test_sequential(self):
+        self._assert_described(self._run())
+
+    @override_settings(DESCRIBE_MODE="parallel", DESCRIBE_CONCURRENCY=3)
+    def test_parallel(self):
+        self._assert_described(self._run())
+
+
+# The heartbeat writes from its own thread, so the rows have to be committed
+@mock.patch("app.jobs._executor")
+class RecoverJobsTests(TransactionTestCase):
+    def _running_job(self, age):
+        job = Job.objects.create(workspace_id="w", video_path=TEST_VIDEO, status=Job.RUNNING)
+        job.record_description(0, {"path": "frame.jpg", "url": "frame.jpg", "description": "Old"})
+        Job.objects.filter(pk=job.pk).update(updated_at=timezone.now() - timedelta(seconds=age))
+        return job
+
+    def test_stale_job_is_requeued_without_its_frames(self, executor):
+        job = self._running_job(settings.JOB_STALE_TIMEOUT + 60)
+        self.assertEqual(jobs.recover_jobs(), 1)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertFalse(Frame.objects.filter(job=job).exists())
+        executor.submit.assert_called_once()
+
+    def test_recent_job_is_left_running(self, executor):
+        job = self._running_job(10)
+        self.assertEqual(jobs.recover_jobs(), 0)
+        self.assertEqual(Job.objects.get(pk=job.pk).status, Job.RUNNING)
+
+    def test_job_running_in_this_process_is_never_requeued(self, executor):
+        job = self._running_job(settings.JOB_STALE_TIMEOUT + 60)
+        with mock.patch.object(jobs, "_running", {job.pk}):
+            self.assertEqual(jobs.recover_jobs(), 0)
+        self.assertEqual(Job.objects.get(pk=job.pk).status, Job.RUNNING)
+
+    @override_settings(JOB_HEARTBEAT_INTERVAL=0.01)
+    def test_heartbeat_keeps_a_slow_job_fresh(self, executor):
+        job = self._running_job(settings.JOB_STALE_TIMEOUT + 60)
+        stopped = threading.Event()
+        heartbeat = threading.Thread(target=jobs._heartbeat, args=(job.pk, stopped))
+        heartbeat.start()
+        try:
+            deadline = timezone.now() + timedelta(seconds=5)
+            while Job.objects.get(pk=job.pk).updated_at < timezone.now() - timedelta(seconds=60):
+                self.assertLess(timezone.now(), deadline)
+                time.sleep(0.01)
+        finally:
+            stopped.set()
+            heartbeat.join()
+
+        self.assertEqual(jobs.recover_jobs(), 0)
@@ -0,0 +1,149 @@
+import os
+import shutil
+import hashlib
+import logging
+import threading
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import Job, Upload, Video
+from .workspace import create_workspace, workspace_dir, touch_workspace
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 1024 * 1024
+
+_lock = threading.Lock()
+_hashers = {}
+_upload_locks = {}
+
+
+def _partial_path(upload):
+    return upload.video_path + ".part"
+
+
+def _upload_lock(upload_id):
+    with _lock:
+        return _upload_locks.setdefault(upload_id, threading.Lock())
+
+
+def _hasher(upload):
+    # The hash is updated as chunks arrive, so completing an upload doesn't re-read the video.
+    # A resume handled by another process rebuilds it once from the bytes already on disk.
+    offset, hasher = _hashers.get(upload.pk, (None, None))
+    if offset == upload.received:
+        return hasher
+
+    hasher = hashlib.sha256()
+    path = _partial_path(upload)
+    if upload.received and os.path.exists(path):
+        with open(path, "rb") as f:
+            remaining = upload.received
+            while remaining:
+                block = f.read(min(READ_SIZE, remaining))
+                if not block:
+                    break
+                hasher.update(block)
+                remaining -= len(block)
+    return hasher
+
+
+def upload_expired(upload):
+    return upload.completed_at is None and not os.path.isdir(workspace_dir(upload.workspace_id))
+
+
+def forget_upload(upload):
+    with _lock:
+        _hashers.pop(upload.pk, None)
+        _upload_locks.pop(upload.pk, None)
+
+
+def start_upload(filename, size):
+    workspace_id = create_workspace()
+    video_path = os.path.join(workspace_dir(workspace_id), os.path.basename(filename))
+    upload = Upload.objects.create(filename=filename, size=size, workspace_id=workspace_id, video_path=video_path)
+    open(_partial_path(upload), "wb").close()
+    return upload
+
+
+def append_chunk(upload, offset, stream):
+    with _upload_lock(upload.pk):
+        upload.refresh_from_db()
+        if offset != upload.received:
+            raise ValueError(f"Expected offset {upload.received}, got {offset}")
+
+        hasher = _hasher(upload)
+        received = upload.received
+        path = _partial_path(upload)
+
+        # Drop whatever an interrupted request wrote past the last acknowledged byte
+        with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+            f.seek(received)
+            f.truncate()
+            while True:
+                block = stream.read(READ_SIZE)
+                if not block:
+                    break
+                if received + len(block) > upload.size:
+                    raise ValueError("Chunk goes past the declared upload size")
+                f.write(block)
+                hasher.update(block)
+                received += len(block)
+
+        upload.received = received
+        upload.save(update_fields=["received", "updated_at"])
+        _hashers[upload.pk] = (received, hasher)
+        touch_workspace(upload.workspace_id)
+        return upload
+
+
+def complete_upload(upload):
+    with _upload_lock(upload.pk):
+        upload.refresh_from_db()
+        if upload.completed_at:
+            return upload
+        if upload.received != upload.size:
+            raise ValueError(f"Upload is incomplete ({upload.received}/{upload.size} bytes)")
+
+        upload.sha256 = _hasher(upload).hexdigest()
+        upload.completed_at = timezone.now()
+
+        os.replace(_partial_path(upload), upload.video_path)
+        upload.video = register_video(
+            upload.sha256, upload.workspace_id, upload.video_path, upload.filename, upload.size
+        )
+        upload.workspace_id = upload.video.workspace_id
+        upload.video_path = upload.video.path
+        upload.save()
+
+    forget_upload(upload)
+    return upload
+
+
+def register_video(sha256, workspace_id, video_path, filename, size):
+    video = Video.objects.filter(sha256=sha256).first()
+    if video is not None and os.path.exists(video.path):
+        # Same content was uploaded before, reuse its workspace so frames and results are shared
+        if video.workspace_id != workspace_id:
+            logger.info(f"{filename} duplicates {video.filename}, reusing workspace {video.workspace_id}")
+            shutil.rmtree(workspace_dir(workspace_id), ignore_errors=True)
+            touch_workspace(video.workspace_id)
+        return video
+
+    video = video or Video(sha256=sha256)
+    video.workspace_id = workspace_id
+    video.path = video_path
+    video.filename = filename
+    video.size = size
+    try:
+        with transaction.atomic():
+            video.save()
+    except IntegrityError:
+        # A concurrent upload of the same content registered it first, share that one
+        return register_video(sha256, workspace_id, video_path, filename, size)
+    return video
+
+
+def finished_job(video, context):
+    return Job.objects.filter(video=video, context=context or "", status=Job.DONE, origin__isnull=True).last()
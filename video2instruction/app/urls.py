@@ -3,9 +3,17 @@ from . import views
 
 urlpatterns = [
     path('', views.upload_view, name='upload'),
+    path("uploads/", views.upload_start_view, name="upload_start"),
+    path("uploads/<uuid:upload_id>/", views.upload_chunk_view, name="upload_chunk"),
+    path("uploads/<uuid:upload_id>/complete/", views.upload_complete_view, name="upload_complete"),
     path('describe/', views.describe_view, name='describe'),
+    path("jobs/<uuid:job_id>/", views.job_status_view, name="job_status"),
+    path("jobs/<uuid:job_id>/result/", views.job_result_view, name="job_result"),
+    path("jobs/<uuid:job_id>/stream/", views.job_stream_view, name="job_stream"),
     path("generate/", views.generate_view, name="generate"),
     path("add_instruction/", views.add_instruction_view, name="add_instruction"),
+    path("add_instruction/precompute/", views.precompute_suggestions_view, name="precompute_suggestions"),
     path("refine/", views.refine_instructions_view, name="refine"),
     path("save_instructions/", views.save_instructions_view, name="save_instructions"),
+    path("metrics", views.metrics_view, name="metrics"),
 ]
@@ -1,53 +1,397 @@
 import os
 import cv2
 import re
-import base64
-
+import json
+import queue
+import asyncio
+import logging
+import threading
+import contextvars
+import multiprocessing
+import numpy as np
+
+import django
+
+from difflib import SequenceMatcher
+from concurrent.futures import ProcessPoolExecutor
 from django.conf import settings
-from ollama import generate
 
 from typing import List
 from pydantic import BaseModel
 from langchain.output_parsers import PydanticOutputParser
 
-def handle_video(video_path, fps=1):
-    frame_dir = os.path.join(settings.MEDIA_ROOT, "frames")
+from . import cache as llm_cache
+from .llm import ChatSession, get_client
+from .metrics import inc, timer, timed_iter
+from .frames import (
+    frame_store, encode_frame, load_image_base64, preprocess_stats, record_preprocess_stats, estimate_baseline_bytes,
+    PREPROCESS_STAT_KEYS
+)
+from .workspace import media_url
+
+logger = logging.getLogger(__name__)
+
+def _generate(model, prompt, images=None, label="generate", **kwargs):
+    key = llm_cache.cache_key(model, prompt, images, **kwargs)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return {"response": cached}
+
+    response = get_client().generate(model, prompt, images=images, label=label, **kwargs)
+    llm_cache.put(key, model, response["response"])
+    return response
+
+
+async def _agenerate(model, prompt, images=None, label="generate", **kwargs):
+    # The cache is SQLite behind a lock, so its I/O runs off the event loop
+    key = llm_cache.cache_key(model, prompt, images, **kwargs)
+    cached = await asyncio.to_thread(llm_cache.get, key)
+    if cached is not None:
+        return {"response": cached}
+
+    response = await get_client().agenerate(model, prompt, images=images, label=label, **kwargs)
+    await asyncio.to_thread(llm_cache.put, key, model, response["response"])
+    return response
+
+
+def _video_interval(video_path, fps):
+    video = cv2.VideoCapture(video_path)
+    video_fps = video.get(cv2.CAP_PROP_FPS)
+    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    video.release()
+    # Sources slower than the target fps (or without fps metadata) keep every frame
+    return max(1, int(video_fps // fps)), frame_count, video_fps
+
+
+def estimate_frame_count(video_path, fps=1, mode=None):
+    interval, frame_count, _ = _video_interval(video_path, fps)
+    count = -(-frame_count // interval)
+    if (mode or settings.FRAME_SELECTION_MODE) == "scene":
+        count = min(count, settings.KEYFRAME_MAX_FRAMES)
+    return count
+
+
+def handle_video(video_path, fps=1, mode=None, frame_dir=None):
+    return list(iter_video_frames(video_path, fps, mode, frame_dir))
+
+
+def iter_video_frames(video_path, fps=1, mode=None, frame_dir=None):
+    mode = mode or settings.FRAME_SELECTION_MODE
+    frame_dir = frame_dir or os.path.join(settings.MEDIA_ROOT, "frames")
     os.makedirs(frame_dir, exist_ok=True)
 
     for f in os.listdir(frame_dir):
         os.remove(os.path.join(frame_dir, f))
+    frame_store.discard_prefix(frame_dir)
+
+    interval, frame_count, video_fps = _video_interval(video_path, fps)
+    stats_before = preprocess_stats()
+
+    if mode == "scene":
+        # Keyframes are ranked over the whole video, so the first pass only keeps a score per
+        # candidate and the chosen frames are decoded a second time to be encoded
+        scan = timed_iter(_iter_samples(video_path, interval, frame_count, _signature_sample), "decode")
+        yield from _extract_scene_keyframes(video_path, scan, frame_dir, video_fps)
+        _log_preprocess_stats(stats_before)
+        return
+
+    samples = timed_iter(_iter_samples(video_path, interval, frame_count, _encode_sample), "decode")
+    for saved, (position, encoded, thumbnail, frame_hash) in enumerate(samples):
+        yield _save_frame(frame_dir, saved, encoded, thumbnail, frame_hash, position, video_fps)
+    _log_preprocess_stats(stats_before)
+
+
+def _log_preprocess_stats(stats_before):
+    stats = preprocess_stats()
+    delta = {key: stats[key] - stats_before[key] for key in PREPROCESS_STAT_KEYS}
+    frames = delta["frames"]
+    model_bytes = delta["model_bytes"]
+    baseline_bytes = estimate_baseline_bytes(frames, delta["baseline_samples"], delta["baseline_sample_bytes"])
+    logger.info(
+        f"Preprocessed {frames} frames: ~{baseline_bytes / 1e6:.1f} MB as full-resolution JPEG -> "
+        f"{model_bytes / 1e6:.2f} MB sent to the model",
+        extra={"frames": frames, "baseline_bytes": baseline_bytes, "model_bytes": model_bytes}
+    )
+
+
+def _iter_samples(video_path, interval, frame_count, sample):
+    if settings.DECODE_WORKERS > 1 and frame_count >= settings.PARALLEL_DECODE_MIN_FRAMES:
+        yield from _decode_parallel(video_path, frame_count, interval, sample)
+        return
 
     video = cv2.VideoCapture(video_path)
-    video_fps = video.get(cv2.CAP_PROP_FPS)
-    interval = int(video_fps // fps)
-    count = saved = 0
-    frames = []
+    try:
+        yield from _decode_samples(video, interval, sample)
+    finally:
+        video.release()
 
-    while True:
+
+def _encode_sample(position, frame):
+    # The dedup hash is taken from the decoded frame here rather than by reading the thumbnail back
+    return (position, *encode_frame(frame), _dhash(frame))
+
+
+def _signature_sample(position, frame):
+    return position, _frame_signature(frame)
+
+
+def _decode_samples(video, interval, sample):
+    for position, frame in _sampled_frames(video, interval):
+        yield sample(position, frame)
+
+
+def _decode_chunk(video_path, start, end, interval, sample):
+    stats_before = preprocess_stats()
+    video = cv2.VideoCapture(video_path)
+    video.set(cv2.CAP_PROP_POS_FRAMES, start)
+    samples = []
+    position = start
+
+    while position < end and video.grab():
+        if position % interval == 0:
+            ret, frame = video.retrieve()
+            if not ret:
+                break
+            samples.append(sample(position, frame))
+        position += 1
+
+    video.release()
+    stats = preprocess_stats()
+    return samples, {key: stats[key] - stats_before[key] for key in PREPROCESS_STAT_KEYS}
+
+
+def _decode_parallel(video_path, frame_count, interval, sample):
+    workers = settings.DECODE_WORKERS
+    # Chunk boundaries sit on multiples of the interval so every worker samples the same positions
+    chunk = -(-frame_count // workers)
+    chunk = -(-chunk // interval) * interval
+    ranges = [(start, min(start + chunk, frame_count)) for start in range(0, frame_count, chunk)]
+
+    # Decoding runs from job threads of a threaded server, a forked child could inherit a lock
+    # another thread was holding (metrics, preprocess stats), so workers start from a fork server
+    executor = ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("forkserver"), initializer=django.setup
+    )
+    with executor:
+        chunks = executor.map(
+            _decode_chunk,
+            [video_path] * len(ranges),
+            [start for start, _ in ranges],
+            [end for _, end in ranges],
+            [interval] * len(ranges),
+            [sample] * len(ranges)
+        )
+        # Chunks come back in order, so earlier chunks can be described while later ones decode
+        for samples, stats in chunks:
+            record_preprocess_stats(stats)
+            yield from samples
+
+
+def _sampled_frames(video, interval):
+    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    if frame_count > 0 and interval >= settings.FRAME_SEEK_MIN_INTERVAL:
+        for position in range(0, frame_count, interval):
+            video.set(cv2.CAP_PROP_POS_FRAMES, position)
+            ret, frame = video.read()
+            if not ret:
+                break
+            yield position, frame
+        return
+
+    # grab() still decodes every frame with the FFmpeg backend, it only skips the BGR conversion
+    # and copy for frames we don't keep. Only the seek path above actually skips decoding.
+    count = 0
+    while video.grab():
+        if count % interval == 0:
+            ret, frame = video.retrieve()
+            if not ret:
+                break
+            yield count, frame
+        count += 1
+
+
+def _frames_at(video, positions):
+    # Far positions are reached with a seek, close ones by grabbing forward like _sampled_frames
+    current = 0
+    for position in positions:
+        if position - current >= settings.FRAME_SEEK_MIN_INTERVAL:
+            video.set(cv2.CAP_PROP_POS_FRAMES, position)
+            current = position
+        while current < position and video.grab():
+            current += 1
         ret, frame = video.read()
         if not ret:
             break
-        if count % interval == 0:
-            filename = f"frame_{saved:04d}.jpg"
-            full_path = os.path.join(frame_dir, filename)
-            cv2.imwrite(full_path, frame)
-            frames.append({
-                "path": full_path,
-                "url": f"frames/{filename}"
-            })
-            saved += 1
-        count += 1
+        current += 1
+        yield position, frame
+
+
+def _save_frame(frame_dir, saved, encoded, thumbnail, frame_hash, position, video_fps):
+    filename = f"frame_{saved:04d}.jpg"
+    full_path = os.path.join(frame_dir, filename)
+    frame_store.put(full_path, encoded.tobytes())
+    thumbnail.tofile(full_path)
+    return {
+        "path": full_path,
+        "url": media_url(full_path),
+        "position": position,
+        "timestamp": position / video_fps if video_fps else 0.0,
+        "dhash": frame_hash
+    }
+
+
+def _frame_signature(frame):
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (64, 36), interpolation=cv2.INTER_AREA).astype(np.float32) / 255.0
+    hist = np.histogram(small, bins=32, range=(0.0, 1.0))[0].astype(np.float32) / small.size
+    return small, hist
 
-    video.release()
-    return frames
 
+def _frame_difference(a, b):
+    pixel_delta = float(np.mean(np.abs(a[0] - b[0])))
+    hist_delta = float(np.sum(np.abs(a[1] - b[1]))) / 2
+    return (pixel_delta + hist_delta) / 2
 
-def ask_questions(paths, context, model="llava"):
-    image_base64_list = []
-    for path in paths:
-        with open(path, "rb") as f:
-            image_base64 = base64.b64encode(f.read()).decode("utf-8")
-        image_base64_list.append(image_base64)
+
+def _select_keyframes(scores, selected, min_frames, max_frames):
+    scores = np.asarray(scores)
+    selected = set(selected)
+
+    if len(selected) > max_frames:
+        ranked = sorted(selected, key=lambda i: scores[i], reverse=True)
+        selected = set(ranked[:max_frames])
+
+    if len(selected) < min_frames:
+        remaining = [i for i in np.argsort(-scores) if i not in selected]
+        selected.update(int(i) for i in remaining[:min_frames - len(selected)])
+
+    return sorted(selected)
+
+
+def _extract_scene_keyframes(video_path, samples, frame_dir, video_fps):
+    positions = []
+    scores = []
+    selected = []
+    last_signature = None
+
+    for i, (position, signature) in enumerate(samples):
+        score = 1.0 if last_signature is None else _frame_difference(signature, last_signature)
+
+        if score >= settings.KEYFRAME_THRESHOLD:
+            selected.append(i)
+            last_signature = signature
+
+        positions.append(position)
+        scores.append(score)
+
+    keep = _select_keyframes(scores, selected, settings.KEYFRAME_MIN_FRAMES, settings.KEYFRAME_MAX_FRAMES)
+
+    # Only the kept frames are encoded, candidates that lost the ranking never are
+    video = cv2.VideoCapture(video_path)
+    try:
+        frames = timed_iter(_frames_at(video, [positions[i] for i in keep]), "decode")
+        for saved, (position, frame) in enumerate(frames):
+            _, encoded, thumbnail, frame_hash = _encode_sample(position, frame)
+            yield _save_frame(frame_dir, saved, encoded, thumbnail, frame_hash, position, video_fps)
+    finally:
+        video.release()
+
+
+def _dhash(image):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def _hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def dedup_frames(frame_data, threshold=None):
+    return list(iter_dedup_frames(frame_data, threshold))
+
+
+def iter_dedup_frames(frame_data, threshold=None):
+    threshold = settings.FRAME_DEDUP_THRESHOLD if threshold is None else threshold
+    run = None
+    run_hash = None
+    total = 0
+    kept = 0
+
+    # A run of similar frames is only passed on once a different frame closes it
+    for i, item in enumerate(frame_data):
+        total += 1
+        frame_hash = item["dhash"]
+
+        if run_hash is not None and _hamming(frame_hash, run_hash) <= threshold:
+            run["range"][1] = i
+            run["frames"].append(item["url"])
+            continue
+
+        if run is not None:
+            kept += 1
+            yield run
+
+        run_hash = frame_hash
+        run = {
+            **{key: value for key, value in item.items() if key != "dhash"},
+            "hash": f"{frame_hash:016x}",
+            "range": [i, i],
+            "frames": [item["url"]]
+        }
+
+    if run is not None:
+        kept += 1
+        yield run
+
+    logger.info(f"Deduplicated {total} frames to {kept}")
+
+
+def prefetch(iterable, size):
+    # Runs the producer in a background thread so it keeps decoding while the consumer
+    # waits on the model, the bounded queue keeps it at most `size` items ahead
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except Exception as e:
+            put((False, e))
+            return
+        put((False, None))
+
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(produce,), name="frame-producer", daemon=True).start()
+
+    try:
+        while True:
+            ok, value = items.get()
+            if not ok:
+                if value is not None:
+                    raise value
+                return
+            yield value
+    finally:
+        stop.set()
+
+
+def ask_questions(paths, context, model=None):
+    model = model or settings.LLM_MODEL
+    image_base64_list = [load_image_base64(path) for path in paths]
 
     prompt = (
         f"The user provided the following context:\n{context.strip()}\n\n"
@@ -60,113 +404,455 @@ def ask_questions(paths, context, model="llava"):
         "- Do not include numbering or bullet points.\n"
     )
 
-    response = generate(
+    response = _generate(
         model=model,
         prompt=prompt,
-        images=image_base64_list
+        images=image_base64_list,
+        label="ask_questions"
     )
 
     return response["response"].strip()
 
-def describe_images(frame_data, context, model="llava", update_progress=None):
+def _describe_system_prompt(context):
+    prompt = f"You are helping create work instructions for people with cognitive disabilities.\n\n"
+    prompt += f"Context provided by the user:\n{context.strip()}"
+    return prompt
+
+def _describe_turn_prompt(index):
+    prompt = f"Now describe image #{index+1}."
+    prompt += "\nDescribe the action in one clear, simple sentence.\nAvoid repeating earlier steps."
+    return prompt
+
+def _describe_prompt(index, context, previous_steps=None, heading=None):
+    prompt = _describe_system_prompt(context) + "\n\n"
+    if previous_steps:
+        heading = heading or f"These are the previous {index} steps:"
+        prompt += f"{heading}\n{previous_steps}\n\n"
+    prompt += f"Now describe image #{index+1}."
+    prompt += "\nDescribe the action in one clear, simple sentence."
+    if previous_steps is not None:
+        prompt += "\nAvoid repeating earlier steps."
+    return prompt
+
+def _numbered_steps(descriptions, start=0):
+    return "\n".join(
+        [f"{start+j+1}. {desc['description']}" for j, desc in enumerate(descriptions)]
+    )
+
+def _summarize_steps(summary, descriptions, start, model):
+    prompt = (
+        "Summarize the following work steps in at most three short sentences, "
+        "keeping the order of the actions.\n\n"
+    )
+    if summary:
+        prompt += f"Summary of the earlier steps:\n{summary}\n\n"
+    prompt += f"New steps:\n{_numbered_steps(descriptions, start)}\n\nRespond with only the summary."
+
+    response = _generate(model=model, prompt=prompt, label="summarize steps")
+    return response["response"].strip()
+
+def _previous_steps_context(descriptions, strategy, summary, summarized):
+    if strategy == "none":
+        return None, None
+
+    if strategy == "last_n":
+        window = descriptions[-settings.DESCRIBE_CONTEXT_LAST_N:]
+        start = len(descriptions) - len(window)
+        heading = f"These are the last {len(window)} steps:" if start else None
+        return _numbered_steps(window, start), heading
+
+    if strategy == "summary" and summary:
+        recent = _numbered_steps(descriptions[summarized:], summarized)
+        return f"{summary}\n{recent}".strip(), "Summary of the steps so far, followed by the latest steps:"
+
+    return _numbered_steps(descriptions), None
+
+def describe_images(frame_data, context, model=None, update_progress=None, on_description=None, context_strategy=None,
+                    total=None):
+    model = model or settings.LLM_MODEL
+    strategy = context_strategy or settings.DESCRIBE_CONTEXT_STRATEGY
     descriptions = []
-    total = len(frame_data)
+    total = total or _frame_total(frame_data)
+    summary = ""
+    summarized = 0
+
+    session = None
+    if strategy == "session":
+        session = ChatSession(
+            model, system=_describe_system_prompt(context), max_turns=settings.DESCRIBE_CONTEXT_LAST_N
+        )
 
     for i, item in enumerate(frame_data):
         try:
-            with open(item["path"], "rb") as f:
-                image_base64 = base64.b64encode(f.read()).decode("utf-8")
+            image_base64 = load_image_base64(item["path"])
 
-            previous_steps = "\n".join(
-                [f"{j+1}. {desc['description']}" for j, desc in enumerate(descriptions)]
-            )
+            if session:
+                description = session.send(
+                    _describe_turn_prompt(i), images=[image_base64], label=f"describe #{i+1}"
+                ).strip()
+            else:
+                if strategy == "summary" and i - summarized >= settings.DESCRIBE_SUMMARY_INTERVAL:
+                    summary = _summarize_steps(summary, descriptions[summarized:], summarized, model)
+                    summarized = i
 
-            prompt = f"You are helping create work instructions for people with cognitive disabilities.\n\n"
-            prompt += f"Context provided by the user:\n{context.strip()}\n\n"
-            if i > 0:
-                prompt += f"These are the previous {i} steps:\n{previous_steps}\n\n"
-            prompt += f"Now describe image #{i+1}."
-            prompt += "\nDescribe the action in one clear, simple sentence.\nAvoid repeating earlier steps."
+                previous_steps, heading = _previous_steps_context(descriptions, strategy, summary, summarized)
 
-            response = generate(model=model, prompt=prompt, images=[image_base64])
-            description = response["response"].strip()
+                prompt = _describe_prompt(i, context, previous_steps, heading)
+                logger.debug(f"Describing frame {i+1}: ~{estimate_tokens(prompt)} prompt tokens")
+                response = _generate(model=model, prompt=prompt, images=[image_base64], label=f"describe #{i+1}")
+                description = response["response"].strip()
 
             descriptions.append({
-                "path": item["path"],
-                "url": item["url"],
+                **item,
                 "description": description
             })
 
-            if update_progress:
-                update_progress((i + 1) / total)
+            if update_progress and total:
+                update_progress(min((i + 1) / total, 1.0))
 
         except Exception as e:
-            print(f"Error describing {item['path']}: {e}")
+            logger.warning(f"Error describing {item['path']}: {e}")
             descriptions.append({
-                "path": item["path"],
-                "url": item["url"],
+                **item,
                 "description": "Error generating description."
             })
 
+        if on_description:
+            on_description(i, descriptions[-1])
+
+    return descriptions
+
+
+def _frame_total(frame_data):
+    # Streamed frames have no length, callers can pass an estimate for progress instead
+    return len(frame_data) if hasattr(frame_data, "__len__") else None
+
+
+def _is_repeated_step(description, previous, threshold):
+    if previous is None or description == "Error generating description.":
+        return False
+    a = re.sub(r"[^a-z0-9 ]", "", description.lower()).strip()
+    b = re.sub(r"[^a-z0-9 ]", "", previous.lower()).strip()
+    return SequenceMatcher(None, a, b).ratio() >= threshold
+
+def describe_images_parallel(frame_data, context, model=None, concurrency=None, update_progress=None, on_description=None,
+                             total=None):
+    model = model or settings.LLM_MODEL
+    concurrency = concurrency or settings.DESCRIBE_CONCURRENCY
+    total = total or _frame_total(frame_data)
+    return asyncio.run(
+        _describe_images_parallel(frame_data, context, model, concurrency, update_progress, on_description, total)
+    )
+
+async def _describe_images_parallel(frame_data, context, model, concurrency, update_progress, on_description, total):
+    semaphore = asyncio.Semaphore(concurrency)
+    emitting = asyncio.Lock()
+    results = {}
+    descriptions = []
+    finished = 0
+    next_index = 0
+    last_kept = None
+
+    # Frames are described independently, so instead of feeding previous steps into
+    # each prompt, results are emitted in frame order and repeated steps are dropped.
+    # The callbacks save to the database, which Django doesn't allow from the event loop.
+    async def emit_ready():
+        nonlocal next_index, last_kept
+        async with emitting:
+            if update_progress and total:
+                await asyncio.to_thread(update_progress, min(finished / total, 1.0))
+            while next_index in results:
+                item = results.pop(next_index)
+                next_index += 1
+                if _is_repeated_step(item["description"], last_kept, settings.DESCRIBE_DEDUP_THRESHOLD):
+                    continue
+                last_kept = item["description"]
+                descriptions.append(item)
+                if on_description:
+                    await asyncio.to_thread(on_description, len(descriptions) - 1, item)
+
+    async def describe(i, item):
+        nonlocal finished
+        try:
+            image_base64 = load_image_base64(item["path"])
+
+            prompt = _describe_prompt(i, context)
+            response = await _agenerate(model=model, prompt=prompt, images=[image_base64], label=f"describe #{i+1}")
+            description = response["response"].strip()
+
+        except Exception as e:
+            logger.warning(f"Error describing {item['path']}: {e}")
+            description = "Error generating description."
+
+        finally:
+            semaphore.release()
+
+        results[i] = {
+            **item,
+            "description": description
+        }
+        finished += 1
+        await emit_ready()
+
+    # Frames may still be decoding, so they are pulled in a worker thread while the event
+    # loop keeps serving model calls, and only once a call slot is free
+    frames = iter(frame_data)
+    end = object()
+    tasks = []
+    while True:
+        await semaphore.acquire()
+        item = await asyncio.to_thread(next, frames, end)
+        if item is end:
+            semaphore.release()
+            break
+        tasks.append(asyncio.create_task(describe(len(tasks), item)))
+
+    await asyncio.gather(*tasks)
     return descriptions
 
 
 class InstructionSet(BaseModel):
     instructions: List[str]
 
-def generate_instructions(descriptions, model="llava"):
-    images = []
-    image_instructions = []
+_INSTRUCTIONS_PREAMBLE = (
+    "You are a careful assistant that generates one short, clear instruction per image description, "
+    "suitable for people with cognitive disabilities.\n"
+    "Instructions must be simple, actionable, and easy to follow.\n"
+    "Do not reference images or numbers.\n"
+    "Write only one instruction per description.\n\n"
+    "Descriptions:\n"
+)
+
+_INSTRUCTIONS_FORMAT = (
+    "\n\nNow respond in this exact JSON format:\n\n"
+    "{\n"
+    '  "instructions": [\n'
+    '    "Instruction for first description.",\n'
+    '    "Instruction for second description.",\n'
+    '    "..."\n'
+    "  ]\n"
+    "}\n\n"
+    "Respond with JSON only. Do not include explanations. Do not include a JSON schema. Do not include markdown (no ```json)."
+)
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+def _instruction_windows(descriptions, with_images):
+    budget = settings.GENERATE_CONTEXT_BUDGET - estimate_tokens(_INSTRUCTIONS_PREAMBLE + _INSTRUCTIONS_FORMAT)
+    window = []
+    used = 0
 
     for item in descriptions:
-        path = item["path"]
-        with open(path, "rb") as f:
-            image_base64 = base64.b64encode(f.read()).decode("utf-8")
-        images.append(image_base64)
-        image_instructions.append(item['description'])
+        cost = estimate_tokens(f"- {item['description']}\n")
+        if with_images:
+            cost += settings.MODEL_IMAGE_TOKENS
+
+        if window and used + cost > budget:
+            yield window
+            window = []
+            used = 0
+
+        window.append(item)
+        used += cost
 
+    if window:
+        yield window
+
+
+def _repair_instruction_set(raw):
+    # Models that drift from the schema usually wrap the JSON in fences or prose,
+    # leave trailing commas or return the bare list, all of which is recoverable locally
+    text = re.sub(r"```(?:json)?", "", raw)
+    match = re.search(r"[\[{].*[\]}]", text, re.S)
+    if match is None:
+        raise ValueError("No JSON found in response")
+    data = json.loads(re.sub(r",\s*([\]}])", r"\1", match.group(0)))
+
+    if isinstance(data, dict):
+        data = data.get("instructions", next((v for v in data.values() if isinstance(v, list)), []))
+
+    instructions = []
+    for item in data:
+        if isinstance(item, dict):
+            item = next((v for v in item.values() if isinstance(v, str)), "")
+        instructions.append(str(item).strip())
+    return InstructionSet(instructions=instructions).instructions
+
+
+def _parse_instruction_set(raw, operation):
     parser = PydanticOutputParser(pydantic_object=InstructionSet)
+    with timer("json_parse"):
+        try:
+            return parser.parse(raw).instructions
+        except Exception:
+            pass
 
-    prompt = (
-        "You are a careful assistant that generates one short, clear instruction per image description, "
-        "suitable for people with cognitive disabilities.\n"
-        "Instructions must be simple, actionable, and easy to follow.\n"
-        "Do not reference images or numbers.\n"
-        "Write only one instruction per description.\n\n"
-        "Descriptions:\n"
+        try:
+            return _repair_instruction_set(raw)
+        except Exception as e:
+            inc("v2i_parse_failures_total", operation=operation)
+            logger.warning(f"Could not parse {operation} response: {e}")
+            return None
+
+
+def _instructions_from_response(response, label):
+    raw = response["response"]
+    logger.debug(f"Raw response: {raw}")
+    return _parse_instruction_set(raw, label)
+
+
+def _forget_instructions_response(model, prompt, images):
+    # Don't serve the broken answer from the cache to the retry
+    llm_cache.delete(llm_cache.cache_key(model, prompt, images, format=InstructionSet.model_json_schema()))
+
+
+def _request_instructions(prompt, model, images, label):
+    response = _generate(model=model, prompt=prompt, images=images, label=label, format=InstructionSet.model_json_schema())
+    instructions = _instructions_from_response(response, label)
+    if instructions is None:
+        _forget_instructions_response(model, prompt, images)
+    return instructions
+
+
+async def _arequest_instructions(prompt, model, images, label):
+    response = await _agenerate(
+        model=model, prompt=prompt, images=images, label=label, format=InstructionSet.model_json_schema()
     )
+    instructions = _instructions_from_response(response, label)
+    if instructions is None:
+        await asyncio.to_thread(_forget_instructions_response, model, prompt, images)
+    return instructions
 
-    prompt += "\n".join(f"- {desc}" for desc in image_instructions)
 
-    prompt += (
-        "\n\nNow respond in this exact JSON format:\n\n"
-        "{\n"
-        '  "instructions": [\n'
-        '    "Instruction for first description.",\n'
-        '    "Instruction for second description.",\n'
-        '    "..."\n'
-        "  ]\n"
-        "}\n\n"
-        "Respond with JSON only. Do not include explanations. Do not include a JSON schema. Do not include markdown (no ```json)."
+def _answer_instructions(items, request, operation):
+    # A short answer keeps what it got right and only the items the model skipped are
+    # asked for again, so what comes back is the answered prefix of the items
+    instructions = []
+    pending = items
+    attempt = 0
+
+    while pending and attempt <= settings.INSTRUCTION_RETRIES:
+        if attempt:
+            _log_retry(operation, pending, items)
+        instructions.extend((request(pending) or [])[:len(pending)])
+        pending = items[len(instructions):]
+        attempt += 1
+
+    return instructions
+
+
+async def _aanswer_instructions(items, request, operation):
+    instructions = []
+    pending = items
+    attempt = 0
+
+    while pending and attempt <= settings.INSTRUCTION_RETRIES:
+        if attempt:
+            _log_retry(operation, pending, items)
+        instructions.extend((await request(pending) or [])[:len(pending)])
+        pending = items[len(instructions):]
+        attempt += 1
+
+    return instructions
+
+
+def _complete_instructions(items, request, operation, fallback):
+    # Whatever the model still hasn't answered falls back to the input text
+    instructions = _answer_instructions(items, request, operation)
+    return instructions + _fallback_instructions(operation, items[len(instructions):], items, fallback)
+
+
+async def _acomplete_instructions(items, request, operation, fallback):
+    instructions = await _aanswer_instructions(items, request, operation)
+    return instructions + _fallback_instructions(operation, items[len(instructions):], items, fallback)
+
+
+def _log_retry(operation, pending, items):
+    inc("v2i_model_retries_total", operation=operation)
+    logger.info(f"Retrying {operation} for {len(pending)} of {len(items)} items")
+
+
+def _fallback_instructions(operation, pending, items, fallback):
+    if pending:
+        logger.warning(f"{operation} is missing {len(pending)} of {len(items)} items, keeping the input text")
+    return [fallback(item) for item in pending]
+
+
+def _instructions_prompt(items):
+    prompt = _INSTRUCTIONS_PREAMBLE
+    prompt += "\n".join(f"- {item['description']}" for item in items)
+    prompt += _INSTRUCTIONS_FORMAT
+    return prompt
+
+
+def _generate_instruction_window(descriptions, model, with_images):
+    def request(items):
+        images = [load_image_base64(item["path"]) for item in items] if with_images else None
+        return _request_instructions(_instructions_prompt(items), model, images, "generate_instructions")
+
+    return _complete_instructions(descriptions, request, "generate_instructions", lambda item: item["description"])
+
+
+async def _agenerate_instruction_window(descriptions, model, with_images):
+    async def request(items):
+        images = None
+        if with_images:
+            images = await asyncio.to_thread(lambda: [load_image_base64(item["path"]) for item in items])
+        return await _arequest_instructions(_instructions_prompt(items), model, images, "generate_instructions")
+
+    return await _acomplete_instructions(
+        descriptions, request, "generate_instructions", lambda item: item["description"]
     )
 
-    response = generate(model=model, prompt=prompt, images=images)
-    raw = response["response"]
-    print("Raw response:", raw)
 
-    try:
-        parsed_obj = parser.parse(raw)
-        return parsed_obj.instructions
-    except Exception as e:
-        print(f"LangChain parsing failed: {e}")
-        return []
-    
-def add_instruction(current_instructions, insert_index, descriptions, model="llava"):
+def generate_instructions(descriptions, model=None, mode=None):
+    model = model or settings.LLM_MODEL
+    mode = mode or settings.GENERATE_INSTRUCTIONS_MODE
+    if mode == "full":
+        return _generate_instruction_window(descriptions, model, with_images=True)
+
+    # "budgeted" splits the steps into windows that fit the context budget,
+    # "text" does the same without attaching images when the descriptions suffice
+    with_images = mode != "text"
+    windows = list(_instruction_windows(descriptions, with_images))
+    logger.info(f"Generating instructions for {len(descriptions)} steps in {len(windows)} windows")
+
+    instructions = []
+    for window in windows:
+        instructions.extend(_generate_instruction_window(window, model, with_images))
+    return instructions
+
+
+async def agenerate_instructions(descriptions, model=None, mode=None):
+    model = model or settings.LLM_MODEL
+    mode = mode or settings.GENERATE_INSTRUCTIONS_MODE
+    if mode == "full":
+        return await _agenerate_instruction_window(descriptions, model, with_images=True)
+
+    # Windows are independent, so they are sent together and spread over the endpoints
+    with_images = mode != "text"
+    windows = list(_instruction_windows(descriptions, with_images))
+    logger.info(f"Generating instructions for {len(descriptions)} steps in {len(windows)} windows")
+
+    results = await asyncio.gather(*(_agenerate_instruction_window(window, model, with_images) for window in windows))
+    return [instruction for window in results for instruction in window]
+
+
+def target_description_for(insert_index, descriptions):
+    if insert_index < len(descriptions):
+        return descriptions[insert_index]
+    return descriptions[-1] if descriptions else "(no description)"
+
+
+def _add_instruction_prompt(current_instructions, insert_index, descriptions):
     prompt = (
         "You are helping create step-by-step work instructions for people with cognitive disabilities.\n\n"
         "Current instructions:\n"
     )
-    print(f"<Current instructions (insert_index={insert_index}): {current_instructions}\n")
+    logger.debug(f"Current instructions (insert_index={insert_index}): {current_instructions}")
     for i, step in enumerate(current_instructions, start=1):
         if step == "":
             prompt += f"{i}. (empty)\n"
@@ -192,12 +878,9 @@ def add_instruction(current_instructions, insert_index, descriptions, model="lla
             f"Step {insert_index + 1}: {after if after != '' else '(empty)'}\n"
         )
 
-    if insert_index < len(descriptions):
-        target_description = descriptions[insert_index]
-    else:
-        target_description = descriptions[-1] if descriptions else "(no description)"
+    target_description = target_description_for(insert_index, descriptions)
 
-    print(f"Target description for new instruction (insert_index={insert_index}): {target_description}")
+    logger.debug(f"Target description for new instruction (insert_index={insert_index}): {target_description}")
     prompt += (
         "\nThe corresponding image description for this new instruction is:\n"
         f"{target_description}\n\n"
@@ -209,19 +892,39 @@ def add_instruction(current_instructions, insert_index, descriptions, model="lla
         "Respond with only the sentence."
     )
 
-    response = generate(model=model, prompt=prompt)
-    raw = response["response"].strip()
+    return prompt
+
 
+def _clean_instruction(raw, insert_index):
+    raw = raw.strip()
     clean = re.sub(r'^["“”]+|["“”]+$', '', raw).strip()
 
-    print(f"Generated new instruction (insert_index={insert_index}): {clean}")
+    logger.info(f"Generated new instruction (insert_index={insert_index}): {clean}")
 
     return clean
 
 
-def refine_instructions(instructions, user_context, model="llava"):
-    parser = PydanticOutputParser(pydantic_object=InstructionSet)
+def add_instruction(current_instructions, insert_index, descriptions, model=None, label="add_instruction"):
+    model = model or settings.LLM_MODEL
+    prompt = _add_instruction_prompt(current_instructions, insert_index, descriptions)
+    response = get_client().generate(model, prompt, label=label)
+    return _clean_instruction(response["response"], insert_index)
+
+
+async def aadd_instruction(current_instructions, insert_index, descriptions, model=None):
+    model = model or settings.LLM_MODEL
+    prompt = _add_instruction_prompt(current_instructions, insert_index, descriptions)
+    response = await get_client().agenerate(model, prompt, label="add_instruction")
+    return _clean_instruction(response["response"], insert_index)
+
 
+def instructions_markdown(texts):
+    lines = ["# Final Instructions\n\n"]
+    lines.extend(f"{i}. {text}\n" for i, text in enumerate(texts, start=1))
+    return "".join(lines)
+
+
+def _refine_prompt(instructions, user_context):
     prompt = (
         "You are refining existing work instructions for people with cognitive disabilities.\n\n"
         "Context provided by the user:\n"
@@ -246,14 +949,72 @@ def refine_instructions(instructions, user_context, model="llava"):
         "}\n\n"
         "Respond with JSON only. Do not include explanations. Do not include a JSON schema. Do not include markdown."
     )
+    return prompt
 
-    response = generate(model=model, prompt=prompt)
-    raw = response["response"]
-    print("Raw response:", raw)
 
-    try:
-        parsed_obj = parser.parse(raw)
-        return parsed_obj.instructions
-    except Exception as e:
-        print(f"LangChain parsing failed: {e}")
-        return []
+def refine_instructions(instructions, user_context, model=None):
+    model = model or settings.LLM_MODEL
+
+    def request(items):
+        return _request_instructions(_refine_prompt(items, user_context), model, None, "refine_instructions")
+
+    return _complete_instructions(instructions, request, "refine_instructions", lambda text: text)
+
+
+def _arefine_request(user_context, model):
+    async def request(items):
+        return await _arequest_instructions(_refine_prompt(items, user_context), model, None, "refine_instructions")
+
+    return request
+
+
+async def arefine_instructions(instructions, user_context, model=None):
+    model = model or settings.LLM_MODEL
+    request = _arefine_request(user_context, model)
+    return await _acomplete_instructions(instructions, request, "refine_instructions", lambda text: text)
+
+
+def _refine_key(model, text, user_context):
+    return llm_cache.cache_key(model, text.strip(), operation="refine", context=user_context.strip())
+
+
+def _remember_refinement(model, text, refined, user_context):
+    llm_cache.put(_refine_key(model, text, user_context), model, refined)
+    # The refined text is what the user sends back next time, so it maps to itself
+    # and only lines edited since the last refine miss the cache
+    llm_cache.put(_refine_key(model, refined, user_context), model, refined)
+
+
+def _cached_refinements(model, instructions, user_context):
+    return [llm_cache.get(_refine_key(model, text, user_context)) for text in instructions]
+
+
+async def arefine_instructions_incremental(instructions, user_context, model=None):
+    # Unchanged lines come back from the cache right away, the changed ones are refined
+    # together in one call so the model still sees them as one ordered list
+    model = model or settings.LLM_MODEL
+    pending = []
+
+    cached = await asyncio.to_thread(_cached_refinements, model, instructions, user_context)
+    for i, refined in enumerate(cached):
+        if refined is None:
+            pending.append(i)
+        else:
+            yield i, refined
+
+    if not pending:
+        return
+    logger.info(f"Refining {len(pending)} of {len(instructions)} instructions changed since the last refine")
+
+    texts = [instructions[i] for i in pending]
+    refined_texts = await _aanswer_instructions(texts, _arefine_request(user_context, model), "refine_instructions")
+    for i, refined in zip(pending, refined_texts):
+        await asyncio.to_thread(_remember_refinement, model, instructions[i], refined, user_context)
+        yield i, refined
+
+    # Lines the model never answered keep their text, and stay out of the cache
+    # so the next refine asks for them again
+    unanswered = pending[len(refined_texts):]
+    fallbacks = _fallback_instructions("refine_instructions", unanswered, pending, lambda i: instructions[i])
+    for i, text in zip(unanswered, fallbacks):
+        yield i, text
@@ -1,33 +1,58 @@
 import os
 import json
-import shutil
+import hashlib
+import asyncio
+import logging
 
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
 from django.shortcuts import render, redirect
+from django.urls import reverse
 from django.conf import settings
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 
 from .forms import UploadForm
-from .utils import handle_video, describe_images, generate_instructions, refine_instructions, add_instruction
+from . import cache as llm_cache
+from . import metrics
+from .frames import preprocess_stats
+from .jobs import enqueue_describe_job, ensure_jobs_recovered, poll_job_events, astream_job_events
+from .llm import timing_stats
+from .models import Job, Upload, InstructionVersion
+from .suggestions import precompute, aget_suggestion
+from .uploads import (
+    start_upload, append_chunk, complete_upload, finished_job, register_video, upload_expired, forget_upload
+)
+from .utils import agenerate_instructions, arefine_instructions_incremental, aadd_instruction, instructions_markdown
+from .workspace import (
+    create_workspace, workspace_dir, instructions_path, media_url, touch_workspace
+)
+
+logger = logging.getLogger(__name__)
 
 def upload_view(request):
     if request.method == "POST":
         form = UploadForm(request.POST, request.FILES)
         if form.is_valid():
-            frames_dir = os.path.join(settings.MEDIA_ROOT, "frames")
-            if os.path.exists(frames_dir):
-                shutil.rmtree(frames_dir)
-            os.makedirs(frames_dir, exist_ok=True)
+            workspace_id = create_workspace()
 
             video = request.FILES["video"]
-            os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
-            video_path = os.path.join(settings.MEDIA_ROOT, video.name)
+            video_path = os.path.join(workspace_dir(workspace_id), os.path.basename(video.name))
+            digest = hashlib.sha256()
 
             with open(video_path, 'wb+') as dest:
                 for chunk in video.chunks():
                     dest.write(chunk)
+                    digest.update(chunk)
 
-            request.session["video_path"] = video_path
+            stored = register_video(digest.hexdigest(), workspace_id, video_path, video.name, video.size)
+            request.session["workspace_id"] = stored.workspace_id
+            request.session["video_path"] = stored.path
             request.session["context"] = request.POST.get("context", "").strip()
+            request.session.pop("job_id", None)
+
+            job = finished_job(stored, request.session["context"])
+            if job is not None:
+                request.session["job_id"] = str(job.pk)
 
             return redirect("describe")
     else:
@@ -35,56 +60,205 @@ def upload_view(request):
 
     return render(request, "upload.html", {"form": form})
 
-def describe_view(request):
-    video_path = request.session.get("video_path")
-    if not video_path:
+def _json_body(request):
+    try:
+        data = json.loads(request.body or "{}")
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+def upload_start_view(request):
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid method"}, status=405)
+
+    data = _json_body(request)
+    if data is None:
+        return JsonResponse({"error": "Request body must be a JSON object"}, status=400)
+    filename = os.path.basename(data.get("filename", ""))
+    size = data.get("size")
+    if not filename or not isinstance(size, int) or size <= 0:
+        return JsonResponse({"error": "filename and size are required"}, status=400)
+
+    upload = start_upload(filename, size)
+    return JsonResponse({"id": str(upload.pk), "offset": upload.received, "size": upload.size}, status=201)
+
+def _expired_upload_response(upload):
+    # The sweeper removed the workspace, the client has to start a new upload
+    forget_upload(upload)
+    upload.delete()
+    return JsonResponse({"error": "Upload expired, start it again"}, status=410)
+
+def upload_chunk_view(request, upload_id):
+    upload = Upload.objects.filter(pk=upload_id).first()
+    if upload is None:
+        return JsonResponse({"error": "Upload not found"}, status=404)
+    if upload_expired(upload):
+        return _expired_upload_response(upload)
+
+    if request.method == "PUT" and not upload.completed_at:
+        # The body is read straight from the request stream, so large chunks never sit in memory
+        try:
+            upload = append_chunk(upload, int(request.headers.get("Upload-Offset", -1)), request)
+        except ValueError as e:
+            upload.refresh_from_db()
+            return JsonResponse({"error": str(e), "offset": upload.received}, status=409)
+        except FileNotFoundError:
+            return _expired_upload_response(upload)
+    elif request.method != "GET":
+        return JsonResponse({"error": "Invalid method"}, status=405)
+
+    return JsonResponse({
+        "id": str(upload.pk),
+        "offset": upload.received,
+        "size": upload.size,
+        "complete": upload.completed_at is not None
+    })
+
+def upload_complete_view(request, upload_id):
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid method"}, status=405)
+
+    upload = Upload.objects.filter(pk=upload_id).first()
+    if upload is None:
+        return JsonResponse({"error": "Upload not found"}, status=404)
+
+    if upload_expired(upload):
+        return _expired_upload_response(upload)
+
+    # Parsed before completing, a bad request must not leave the upload half handled
+    data = _json_body(request)
+    if data is None:
+        return JsonResponse({"error": "Request body must be a JSON object"}, status=400)
+    context = str(data.get("context") or "").strip()
+
+    try:
+        upload = complete_upload(upload)
+    except ValueError as e:
+        return JsonResponse({"error": str(e), "offset": upload.received}, status=409)
+    except FileNotFoundError:
+        return _expired_upload_response(upload)
+
+    request.session["workspace_id"] = upload.workspace_id
+    request.session["video_path"] = upload.video_path
+    request.session["context"] = context
+    request.session.pop("job_id", None)
+
+    # An identical video with the same context was already described, show that result right away
+    job = finished_job(upload.video, context)
+    if job is not None:
+        request.session["job_id"] = str(job.pk)
+
+    return JsonResponse({"sha256": upload.sha256, "redirect": reverse("describe")})
+
+async def describe_view(request):
+    video_path = await request.session.aget("video_path")
+    workspace_id = await request.session.aget("workspace_id")
+    if not video_path or not workspace_id:
         return redirect("upload")
 
-    frame_data = handle_video(video_path)
+    await asyncio.to_thread(touch_workspace, workspace_id)
+    # The first request after a restart picks up the jobs the previous process left behind
+    await sync_to_async(ensure_jobs_recovered)()
+    job_id = await request.session.aget("job_id")
+    job = await Job.objects.filter(pk=job_id).afirst() if job_id else None
 
-    context = request.session.get("context")
-    print("Context loaded:", context)
+    if job is None or job.video_path != video_path:
+        context = await request.session.aget("context")
+        logger.debug(f"Context loaded: {context}")
 
-    descriptions = describe_images(frame_data, context)
+        job = await sync_to_async(enqueue_describe_job)(video_path, context, workspace_id)
+        await request.session.aset("job_id", str(job.pk))
 
-    descriptions_path = os.path.join(settings.MEDIA_ROOT, "descriptions.json")
-    with open(descriptions_path, "w", encoding="utf-8") as f:
-        json.dump(descriptions, f, indent=2)
+    descriptions = await sync_to_async(job.descriptions)() if job.status == Job.DONE else []
 
     return render(request, "describe.html", {
+        "job": job,
         "descriptions": descriptions,
         "media_url": "/media/"
     })
 
-def generate_view(request):
-    descriptions = []
-    total = int(request.POST.get("total", 0))
+def job_status_view(request, job_id):
+    job = Job.objects.filter(pk=job_id).first()
+    if job is None:
+        return JsonResponse({"error": "Job not found"}, status=404)
 
-    video_path = request.session.get("video_path")
-    video_filename = os.path.basename(video_path) if video_path else ""
+    return JsonResponse({
+        "id": str(job.pk),
+        "status": job.status,
+        "progress": job.progress,
+        "error": job.error
+    })
 
-    request.session["video_path"]
+def job_stream_view(request, job_id):
+    if not Job.objects.filter(pk=job_id).exists():
+        return JsonResponse({"error": "Job not found"}, status=404)
 
-    for i in range(total):
-        if request.POST.get(f"deleted_{i}") == "true":
-            continue
+    # A reconnecting EventSource sends the id of the last description it received
+    last_event_id = request.headers.get("Last-Event-ID", "")
+    sent = int(last_event_id) if last_event_id.isdigit() else 0
+
+    if isinstance(request, ASGIRequest):
+        response = StreamingHttpResponse(astream_job_events(job_id, sent), content_type="text/event-stream")
+    else:
+        response = HttpResponse("".join(poll_job_events(job_id, sent)), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+def job_result_view(request, job_id):
+    job = Job.objects.filter(pk=job_id).first()
+    if job is None:
+        return JsonResponse({"error": "Job not found"}, status=404)
+
+    if job.status == Job.FAILED:
+        return JsonResponse({"status": job.status, "error": job.error}, status=500)
 
-        path = request.POST.get(f"path_{i}")
-        description = request.POST.get(f"description_{i}")
-        descriptions.append({"path": path, "description": description})
+    if job.status != Job.DONE:
+        return JsonResponse({"status": job.status, "progress": job.progress}, status=202)
 
-    descriptions_path = os.path.join("media", "descriptions.json")
-    with open(descriptions_path, "w", encoding="utf-8") as f:
-        json.dump(descriptions, f, indent=2)
+    return JsonResponse({"status": job.status, "descriptions": job.descriptions()})
 
-    instructions = generate_instructions(descriptions)
+async def _session_job(request):
+    job_id = await request.session.aget("job_id")
+    return await Job.objects.filter(pk=job_id).afirst() if job_id else None
+
+async def generate_view(request):
+    video_path = await request.session.aget("video_path")
+    video_url = media_url(video_path) if video_path else ""
+
+    workspace_id = await request.session.aget("workspace_id")
+    job = await _session_job(request)
+    if not workspace_id or job is None:
+        return redirect("upload")
+    if job.status != Job.DONE:
+        return redirect("describe")
+    await asyncio.to_thread(touch_workspace, workspace_id)
+
+    if job.origin_id is None:
+        job = await sync_to_async(job.copy)()
+        await request.session.aset("job_id", str(job.pk))
+
+    # Fields are named after the frame index, deleted frames are no longer on the page
+    edits = {
+        i: (request.POST.get(f"description_{i}", ""), request.POST.get(f"deleted_{i}") == "true")
+        for i in map(int, request.POST.getlist("frame"))
+    }
+    await sync_to_async(job.update_descriptions)(edits)
+    descriptions = await sync_to_async(job.descriptions)()
+
+    instructions = await agenerate_instructions(descriptions)
+    await sync_to_async(InstructionVersion.record)(job, instructions, InstructionVersion.GENERATED)
+
+    if settings.ADD_INSTRUCTION_PRECOMPUTE:
+        precompute(job.pk, instructions, [item["description"] for item in descriptions])
 
     return render(request, "generate.html", {
         "instructions": instructions,
-        "video_filename": video_filename
+        "video_url": video_url,
+        "precompute_suggestions": settings.ADD_INSTRUCTION_PRECOMPUTE
     })
 
-def add_instruction_view(request):
+async def add_instruction_view(request):
     if request.method != "POST":
         return JsonResponse({"error": "Invalid method"}, status=405)
 
@@ -97,25 +271,52 @@ def add_instruction_view(request):
         insert_index = data.get("insert_index", len(current_texts))
         insert_index = max(0, min(insert_index, len(current_texts))) 
 
-        descriptions_path = os.path.join(settings.MEDIA_ROOT, "descriptions.json")
-        with open(descriptions_path, "r", encoding="utf-8") as f:
-            descriptions_data = json.load(f)
+        job = await _session_job(request)
+        if job is None:
+            return JsonResponse({"error": "No active workspace"}, status=400)
 
-        descriptions = [item["description"] for item in descriptions_data]
+        descriptions = [item["description"] for item in await sync_to_async(job.descriptions)()]
 
-        new_instruction = add_instruction(current_texts, insert_index, descriptions)
+        new_instruction = None
+        if settings.ADD_INSTRUCTION_PRECOMPUTE:
+            new_instruction = await aget_suggestion(current_texts, insert_index, descriptions)
+        if new_instruction is None:
+            new_instruction = await aadd_instruction(current_texts, insert_index, descriptions)
 
         return JsonResponse({
             "new_instruction": new_instruction
         })
 
     except Exception as e:
-        print(f"Error in add_instruction_view: {e}")
+        logger.exception(f"Error in add_instruction_view: {e}")
+        return JsonResponse({"error": str(e)}, status=500)
+
+async def precompute_suggestions_view(request):
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid method"}, status=405)
+    if not settings.ADD_INSTRUCTION_PRECOMPUTE:
+        return JsonResponse({"scheduled": 0})
+
+    try:
+        data = json.loads(request.body)
+        current_texts = [instr["text"].strip() for instr in data.get("instructions", [])]
+
+        job = await _session_job(request)
+        if job is None:
+            return JsonResponse({"error": "No active workspace"}, status=400)
+
+        descriptions = [item["description"] for item in await sync_to_async(job.descriptions)()]
+        scheduled = precompute(job.pk, current_texts, descriptions)
+
+        return JsonResponse({"scheduled": scheduled})
+
+    except Exception as e:
+        logger.exception(f"Error in precompute_suggestions_view: {e}")
         return JsonResponse({"error": str(e)}, status=500)
 
 
 
-def refine_instructions_view(request):
+async def refine_instructions_view(request):
     if request.method != "POST":
         return JsonResponse({"error": "Invalid method"}, status=405)
 
@@ -124,44 +325,49 @@ def refine_instructions_view(request):
         refine_context = data.get("refine_context", "")
         instructions = data.get("instructions", [])
 
-        unlocked_texts = []
-        unlocked_mapping = []
-
-        for instr in instructions:
-            if not instr["locked"]:
-                text = instr["text"].strip()
-                if text != '':
-                    unlocked_mapping.append(True)
-                    unlocked_texts.append(text)
-                else:
-                    unlocked_mapping.append(False)
-
-        print(f"refine context: {refine_context}")
-        refined_texts = refine_instructions(unlocked_texts, refine_context)
-
-        result = []
-        unlocked_index = 0
-
-        for instr in instructions:
-            if instr["locked"]:
-                result.append(instr["text"])
-            else:
-                if unlocked_mapping[unlocked_index]:
-                    result.append(refined_texts[unlocked_index])
-                    unlocked_index += 1
-                else:
-                    result.append('')
+        # Positions of the unlocked, non-empty instructions, the only ones sent to the model
+        positions = [
+            index for index, instr in enumerate(instructions)
+            if not instr["locked"] and instr["text"].strip() != ''
+        ]
+        unlocked_texts = [instructions[index]["text"].strip() for index in positions]
+
+        logger.debug(f"refine context: {refine_context}")
+        refined = arefine_instructions_incremental(unlocked_texts, refine_context)
+
+        if data.get("stream"):
+            async def events():
+                try:
+                    async for i, text in refined:
+                        yield json.dumps({"index": positions[i], "text": text}) + "\n"
+                except Exception as e:
+                    logger.exception(f"Error while streaming refined instructions: {e}")
+                    yield json.dumps({"error": str(e)}) + "\n"
+
+            response = StreamingHttpResponse(events(), content_type="application/x-ndjson")
+            response["X-Accel-Buffering"] = "no"
+            return response
+
+        result = [instr["text"] if instr["locked"] or instr["text"].strip() else '' for instr in instructions]
+        async for i, text in refined:
+            result[positions[i]] = text
 
         return JsonResponse({"refined_instructions": result})
 
     except Exception as e:
-        print(f"Error in refine_instructions_view: {e}")
+        logger.exception(f"Error in refine_instructions_view: {e}")
         return JsonResponse({"error": str(e)}, status=500)
 
 def save_instructions_view(request):
     if request.method != "POST":
         return redirect("generate")
 
+    workspace_id = request.session.get("workspace_id")
+    job_id = request.session.get("job_id")
+    job = Job.objects.filter(pk=job_id).first() if job_id else None
+    if not workspace_id or job is None:
+        return redirect("upload")
+
     total = int(request.POST.get("total", 0))
     final = []
 
@@ -170,13 +376,49 @@ def save_instructions_view(request):
         final.append({
             "text": text
         })
+    texts = [item["text"] for item in final]
 
-    with open("media/descriptions.json", "w", encoding="utf-8") as f:
-        json.dump(final, f, indent=2)
-    
-    with open("media/final_instructions.md", "w", encoding="utf-8") as f:
-            f.write("# Final Instructions\n\n")
-            for i, item in enumerate(final, start=1):
-                f.write(f"{i}. {item['text']}\n")
+    InstructionVersion.record(job, texts, InstructionVersion.SAVED)
+
+    # The Markdown file is only the download, the saved versions live in the database
+    markdown_path = instructions_path(workspace_id, job.pk)
+    os.makedirs(os.path.dirname(markdown_path), exist_ok=True)
+    with open(markdown_path, "w", encoding="utf-8") as f:
+        f.write(instructions_markdown(texts))
+
+    return render(request, "done.html", {
+        "instructions": final,
+        "download_url": media_url(markdown_path)
+    })
 
-    return render(request, "done.html", {"instructions": final})
\ No newline at end of file
+def metrics_view(request):
+    cache = llm_cache.stats()
+    timings = timing_stats()
+    frames = preprocess_stats()
+
+    extra = {
+        "v2i_job_queue_depth": ("gauge", "Describe jobs waiting for a worker.", Job.objects.filter(status=Job.QUEUED).count()),
+        "v2i_jobs_running": ("gauge", "Describe jobs currently running.", Job.objects.filter(status=Job.RUNNING).count()),
+        "v2i_llm_cache_hits_total": ("counter", "Model responses served from the cache.", cache["hits"]),
+        "v2i_llm_cache_misses_total": ("counter", "Model responses not found in the cache.", cache["misses"]),
+        "v2i_model_prompt_tokens_total": ("counter", "Prompt tokens processed by the model.", timings["prompt_tokens"]),
+        "v2i_model_eval_tokens_total": ("counter", "Tokens generated by the model.", timings["eval_tokens"]),
+        "v2i_model_prefill_seconds_total": ("counter", "Time the model spent on prompt processing.", timings["prefill_ms"] / 1000),
+        "v2i_model_eval_seconds_total": ("counter", "Time the model spent generating tokens.", timings["eval_ms"] / 1000),
+        "v2i_frames_encoded_total": ("counter", "Frames encoded for the model.", frames["frames"]),
+        "v2i_frame_bytes_encoded_total": ("counter", "Bytes of encoded frames sent to the model.", frames["model_bytes"]),
+        "v2i_frame_baseline_samples_total": (
+            "counter", "Frames also encoded as full-resolution JPEGs to measure the preprocessing saving.",
+            frames["baseline_samples"]
+        ),
+        "v2i_frame_bytes_baseline_sampled_total": (
+            "counter", "Bytes the sampled frames take as full-resolution JPEGs, as sent before preprocessing.",
+            frames["baseline_sample_bytes"]
+        ),
+        "v2i_frame_bytes_baseline_estimate": (
+            "gauge", "Estimated bytes of all encoded frames as full-resolution JPEGs, scaled from the sample.",
+            frames["baseline_bytes"]
+        ),
+    }
+
+    return HttpResponse(metrics.render(extra), content_type="text/plain; version=0.0.4")
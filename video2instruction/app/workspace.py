@@ -0,0 +1,105 @@
+import os
+import time
+import uuid
+import shutil
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .frames import frame_store
+
+logger = logging.getLogger(__name__)
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def workspace_root():
+    return os.path.join(settings.MEDIA_ROOT, "workspaces")
+
+
+def workspace_dir(workspace_id):
+    return os.path.join(workspace_root(), workspace_id)
+
+
+def frames_dir(workspace_id, job_id=None):
+    # Deduplicated uploads share a workspace, every job extracts into its own directory
+    path = os.path.join(workspace_dir(workspace_id), "frames")
+    return os.path.join(path, str(job_id)) if job_id else path
+
+
+def instructions_path(workspace_id, job_id):
+    # Sessions on a deduplicated upload share the workspace, each job saves its own file
+    return os.path.join(workspace_dir(workspace_id), "instructions", str(job_id), "final_instructions.md")
+
+
+def media_url(path):
+    return os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, "/")
+
+
+def create_workspace():
+    workspace_id = uuid.uuid4().hex
+    os.makedirs(frames_dir(workspace_id), exist_ok=True)
+    ensure_sweeper_running()
+    return workspace_id
+
+
+def touch_workspace(workspace_id):
+    path = workspace_dir(workspace_id)
+    if os.path.isdir(path):
+        os.utime(path)
+
+
+def sweep_workspaces(ttl=None):
+    from .models import Job, Upload
+
+    ttl = settings.WORKSPACE_TTL if ttl is None else ttl
+    root = workspace_root()
+    if not os.path.isdir(root):
+        return 0
+
+    active = set(
+        Job.objects.filter(status__in=[Job.QUEUED, Job.RUNNING]).values_list("workspace_id", flat=True)
+    )
+    cutoff = time.time() - ttl
+    removed = []
+
+    for workspace_id in os.listdir(root):
+        path = os.path.join(root, workspace_id)
+        if workspace_id in active or not os.path.isdir(path):
+            continue
+        if os.path.getmtime(path) < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+            frame_store.discard_prefix(path)
+            removed.append(workspace_id)
+
+    if removed:
+        # Unfinished uploads into a removed workspace can't be resumed anymore
+        Upload.objects.filter(workspace_id__in=removed, completed_at__isnull=True).delete()
+        logger.info(f"Removed {len(removed)} expired workspaces")
+    return len(removed)
+
+
+def _sweep_forever():
+    from .jobs import recover_jobs
+
+    while True:
+        time.sleep(settings.WORKSPACE_SWEEP_INTERVAL)
+        try:
+            # Jobs stuck in a stopped process would keep their workspace from ever expiring
+            recover_jobs()
+            sweep_workspaces()
+        except Exception as e:
+            logger.exception(f"Workspace sweep failed: {e}")
+        finally:
+            close_old_connections()
+
+
+def ensure_sweeper_running():
+    global _sweeper
+    with _sweeper_lock:
+        if _sweeper is None or not _sweeper.is_alive():
+            _sweeper = threading.Thread(target=_sweep_forever, name="workspace-sweeper", daemon=True)
+            _sweeper.start()
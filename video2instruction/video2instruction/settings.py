@@ -113,4 +113,113 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 MEDIA_URL = '/media/'
-MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
\ No newline at end of file
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# Background jobs for the describe pipeline (in-process worker pool, state kept in the database)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_STREAM_POLL_INTERVAL = 0.5
+# Under WSGI the job stream answers one round of events per request and the browser reconnects after this delay
+JOB_POLL_RETRY_MS = 1000
+# Running jobs that haven't saved progress for this long were left behind by a stopped process and are requeued
+JOB_STALE_TIMEOUT = 10 * 60
+# Running jobs touch their row this often, so slow decoding or model calls don't look like a stopped process
+JOB_HEARTBEAT_INTERVAL = 60
+# Job streams without any change for this long are closed, the page asks the user to reload
+JOB_STREAM_STALL_TIMEOUT = 5 * 60
+
+# Model serving: "ollama", "openai" (any OpenAI-compatible server) or "fake" (offline, deterministic)
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "ollama")
+LLM_MODEL = os.environ.get("LLM_MODEL", "llava")
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST")
+# Comma separated endpoints; requests are spread over them with LLM_ROUTING ("round_robin" or "least_loaded")
+LLM_ENDPOINTS = [e.strip() for e in os.environ.get("LLM_ENDPOINTS", OLLAMA_HOST or "").split(",") if e.strip()]
+LLM_ROUTING = os.environ.get("LLM_ROUTING", "least_loaded")
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "not-needed")
+FAKE_LLM_LATENCY = float(os.environ.get("FAKE_LLM_LATENCY", 0.0))
+FAKE_LLM_IMAGE_LATENCY = float(os.environ.get("FAKE_LLM_IMAGE_LATENCY", 0.0))
+# How long Ollama keeps the model loaded after a request, so its KV cache survives between pipeline steps
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+# "sequential" feeds previous steps into each prompt, "parallel" describes frames concurrently
+DESCRIBE_MODE = os.environ.get("DESCRIBE_MODE", "sequential")
+DESCRIBE_CONCURRENCY = int(os.environ.get("DESCRIBE_CONCURRENCY", 4))
+DESCRIBE_DEDUP_THRESHOLD = 0.9
+# Previous steps fed into each sequential describe prompt: "all", "last_n", "summary" or "none".
+# "session" describes frames as turns of one chat so earlier turns are reused from the KV cache,
+# keeping at most DESCRIBE_CONTEXT_LAST_N earlier turns as text.
+DESCRIBE_CONTEXT_STRATEGY = os.environ.get("DESCRIBE_CONTEXT_STRATEGY", "last_n")
+DESCRIBE_CONTEXT_LAST_N = 5
+DESCRIBE_SUMMARY_INTERVAL = 8
+
+# Frame extraction: "interval" keeps one frame per second, "scene" only keeps frames at scene changes
+FRAME_SELECTION_MODE = os.environ.get("FRAME_SELECTION_MODE", "interval")
+KEYFRAME_THRESHOLD = 0.05
+KEYFRAME_MIN_FRAMES = 3
+KEYFRAME_MAX_FRAMES = 40
+
+# Collapse runs of near-identical frames (dHash Hamming distance) before describing them
+FRAME_DEDUP = os.environ.get("FRAME_DEDUP", "1") == "1"
+FRAME_DEDUP_THRESHOLD = 5
+
+# Persistent cache of model responses keyed on model, prompt and image bytes
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_PATH = BASE_DIR / "llm_cache.sqlite3"
+LLM_CACHE_MAX_ENTRIES = 10000
+LLM_CACHE_TOUCH_INTERVAL = 60 * 60
+
+# Per-upload workspaces under MEDIA_ROOT/workspaces, removed after WORKSPACE_TTL seconds of inactivity
+WORKSPACE_TTL = 24 * 60 * 60
+WORKSPACE_SWEEP_INTERVAL = 60 * 60
+
+# Extracted frames stay in memory as JPEG/base64; only thumbnails for the templates are written to disk
+FRAME_STORE_MAX_FRAMES = 2000
+FRAME_THUMBNAIL_MAX_SIDE = 640
+FRAME_THUMBNAIL_QUALITY = 80
+# Sampling intervals of at least this many frames seek instead of grabbing every frame. Grabbing still
+# decodes each frame, seeking only decodes from the nearest keyframe, which pays off at long intervals.
+FRAME_SEEK_MIN_INTERVAL = 120
+# Videos with at least PARALLEL_DECODE_MIN_FRAMES frames are decoded in DECODE_WORKERS processes
+DECODE_WORKERS = int(os.environ.get("DECODE_WORKERS", 1))
+PARALLEL_DECODE_MIN_FRAMES = 3000
+# Decoded frames buffered ahead of the describe stage
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 8))
+
+# Preprocessing applied once per frame before it is sent to the model
+MODEL_FRAME_MAX_SIDE = int(os.environ.get("MODEL_FRAME_MAX_SIDE", 1024))
+MODEL_FRAME_JPEG_QUALITY = int(os.environ.get("MODEL_FRAME_JPEG_QUALITY", 85))
+MODEL_FRAME_GRAYSCALE = os.environ.get("MODEL_FRAME_GRAYSCALE", "0") == "1"
+# (x, y, width, height) as fractions of the frame, or None to keep the whole frame
+MODEL_FRAME_CROP = None
+# The full-resolution JPEG size behind the bytes-saved stats is only measured on one frame in this many
+PREPROCESS_BASELINE_SAMPLE_EVERY = 25
+
+# generate_instructions: "full" sends every image in one call, "budgeted" splits steps into windows that
+# fit GENERATE_CONTEXT_BUDGET tokens, "text" does the same without images
+GENERATE_INSTRUCTIONS_MODE = os.environ.get("GENERATE_INSTRUCTIONS_MODE", "budgeted")
+GENERATE_CONTEXT_BUDGET = 4096
+MODEL_IMAGE_TOKENS = 576
+
+# Follow-up calls for instructions missing from a short or unparseable JSON answer
+INSTRUCTION_RETRIES = int(os.environ.get("INSTRUCTION_RETRIES", 1))
+
+# Precompute add_instruction suggestions for every gap in the background after generating
+ADD_INSTRUCTION_PRECOMPUTE = os.environ.get("ADD_INSTRUCTION_PRECOMPUTE", "0") == "1"
+ADD_INSTRUCTION_PRECOMPUTE_WORKERS = int(os.environ.get("ADD_INSTRUCTION_PRECOMPUTE_WORKERS", 2))
+ADD_INSTRUCTION_SUGGESTIONS_MAX = 1024
+
+# Structured JSON logs for the app, tagged with the id of the job being processed
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "filters": {
+        "job_id": {"()": "app.metrics.JobIdFilter"},
+    },
+    "formatters": {
+        "json": {"()": "app.metrics.JsonFormatter"},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "filters": ["job_id"], "formatter": "json"},
+    },
+    "loggers": {
+        "app": {"handlers": ["console"], "level": os.environ.get("APP_LOG_LEVEL", "INFO"), "propagate": False},
+    },
+}